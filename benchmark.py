@@ -0,0 +1,379 @@
+"""
+
+Benchmarks for performance sensitive parts of client.py and server.py.
+Every benchmark prints its results and exits with non-zero code, when
+the measured value exceeds its budget.
+
+"""
+
+import subprocess
+import tempfile
+import argparse
+import random
+import socket
+import csv
+import sys
+import os
+import time
+
+
+class ArgParser(object):
+    """
+    Class for argument parsing. Retrieves which benchmark should be executed
+    and its parameters.
+    """
+
+    def __init__(self):
+        """
+        Initializes instance and parses all arguments. Afterwards you can call self.args
+        with the name of the parameter.
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument('benchmark', help='Benchmark to execute', choices=sorted(BENCHMARKS))
+        parser.add_argument('-d', '--devices', help='Number of simulated devices', type=int, default=500)
+        parser.add_argument('-n', '--iterations', help='Number of measured iterations', type=int, default=50)
+        parser.add_argument('-t', '--trace', help='CSV file recorded with server.py --output', type=str, default=None)
+        self.args = parser.parse_args()
+
+
+def benchmark_fleet_plotter(args):
+    """
+    Renders FleetPlotter headless (Agg backend), each frame preceded by a new sample
+    from every connected device. Devices join gradually during the first half of frames
+    (heatmap grid grows), temperature and network rates trend upwards (drill-down is
+    rescaled) and every 10th frame other device is selected. Budget: 50 ms per frame
+    (worst frame after the first one, which lays out the figure).
+
+    Returns:
+        passed(bool): True if the frame time is within budget
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import numpy as np
+    import server
+
+    class Sample(object):
+        pass
+
+    state = server.FleetState()
+    plotter = server.FleetPlotter(state, show=False)
+    rng = np.random.default_rng(0)
+    sample = Sample()
+
+    full_redraws = 0
+    canvas_draw = plotter.figure.canvas.draw
+
+    def counted_draw(*draw_args, **draw_kwargs):
+        nonlocal full_redraws
+        full_redraws += 1
+        canvas_draw(*draw_args, **draw_kwargs)
+
+    plotter.figure.canvas.draw = counted_draw
+
+    frame_times = []
+    for frame in range(args.iterations):
+        trend = frame / max(args.iterations - 1, 1)
+        devices = max(1, min(args.devices, round(args.devices * (frame + 1) / max(args.iterations // 2, 1))))
+        for device in range(devices):
+            sample.cpu_usage, sample.temperature, sample.clock_arm = rng.random(3) * (100, 10, 1.5e9)
+            sample.temperature += 40 + 40 * trend
+            sample.bitrate = tuple(rng.random(2) * 100)
+            sample.network_rate = tuple(rng.random(2) * 10 + 1000 * trend ** 2)
+            state.update("10.0.{}.{}".format(device // 256, device % 256), sample)
+        if frame % 10 == 9:
+            plotter.select_device(state.devices[(frame * 7) % len(state.devices)])
+
+        start = time.perf_counter()
+        plotter.draw()
+        frame_times.append(time.perf_counter() - start)
+
+    # first frame lays out the whole figure
+    measured = sorted(frame_times[1:] or frame_times)
+    median_ms = measured[len(measured) // 2] * 1000
+    p95_ms = measured[int(len(measured) * 0.95)] * 1000
+    worst_ms = measured[-1] * 1000
+    print("fleet_plotter: devices={} frames={} median={:.1f} ms p95={:.1f} ms worst={:.1f} ms first={:.1f} ms "
+          "full_redraws={}".format(args.devices, args.iterations, median_ms, p95_ms, worst_ms,
+                                   frame_times[0] * 1000, full_redraws))
+    return worst_ms < 50.0
+
+
+def benchmark_client_cold_start(args):
+    """
+    Starts new interpreter, which imports client.py, resolves dependencies and collects
+    first sample (iperf excluded, it is sent one loop later). Dependency cache is warmed
+    up by the first run. Budget: 1 s from process start to the first sample.
+
+    Returns:
+        passed(bool): True if the slowest start is within budget
+    """
+    first_sample_script = (
+        "import time; start = time.perf_counter(); import client; "
+        "collector = client.MetricCollector(client.LinuxDependencies.get_metric_backends()); "
+        "collector.collect(); client.SystemSnapshot(); print(time.perf_counter() - start)"
+    )
+    cwd = os.path.dirname(os.path.realpath(__file__))
+
+    start_times = []
+    in_process_times = []
+    for _ in range(max(2, min(args.iterations, 10))):
+        start = time.perf_counter()
+        output = subprocess.check_output([sys.executable, "-c", first_sample_script], cwd=cwd)
+        start_times.append(time.perf_counter() - start)
+        in_process_times.append(float(output))
+
+    # first run may create dependency cache
+    worst_ms = max(start_times[1:]) * 1000
+    print("client_cold_start: runs={} process={:.1f} ms (worst) in_process={:.1f} ms (worst)".format(
+        len(start_times) - 1, worst_ms, max(in_process_times[1:]) * 1000))
+    return worst_ms < 1000.0
+
+
+def synthetic_idle_trace(samples):
+    """
+    Generates trace of one idle RPi sampled every 2 seconds: noisy low cpu usage with
+    rare spikes, linear uptime, flat temperature, pinned clock and little traffic.
+
+    Attributes:
+        samples(int): number of samples
+
+    Returns:
+        traces(dict(str, list(dict(str, str)))): device id with its samples
+    """
+    rng = random.Random(0)
+    timestamp, uptime, temperature = 1.7e9, 1000.0, 45.0
+    trace = []
+
+    for _ in range(samples):
+        elapsed = 2.0 + rng.uniform(-0.02, 0.02)
+        timestamp += elapsed
+        uptime += elapsed
+        temperature = min(50.0, max(40.0, temperature + rng.choice((-0.1, 0.0, 0.0, 0.0, 0.1))))
+        spike = rng.random() < 0.01
+        trace.append({
+            "Time": "{:.3f}".format(timestamp),
+            "CPU_Usage": "{:.2f}".format(rng.uniform(40, 90) if spike else max(0.0, rng.gauss(3.0, 0.5))),
+            "Uptime": "{:.2f}".format(uptime),
+            "Temperature": "{:.1f}".format(temperature),
+            "ClockArm": "1200000000" if spike else "600000000",
+            "SendBitrate": "0",
+            "RecvBitrate": "0",
+            "NetRx[eth0]": "{:.3f}".format(abs(rng.gauss(0.01, 0.005))),
+            "NetTx[eth0]": "{:.3f}".format(abs(rng.gauss(0.005, 0.003))),
+        })
+
+    return {"synthetic": trace}
+
+
+def load_trace(path):
+    """
+    Loads trace recorded with server.py --output.
+
+    Attributes:
+        path(str): path of the CSV file
+
+    Returns:
+        traces(dict(str, list(dict(str, str)))): device id with its samples
+    """
+    keys = ("CPU_Usage", "Uptime", "Temperature", "ClockArm", "SendBitrate", "RecvBitrate", "NetRx[all]", "NetTx[all]")
+    traces = {}
+    with open(path) as trace_file:
+        for row in csv.reader(trace_file):
+            values = dict(zip(keys, row[2:]))
+            values["Time"] = row[0]
+            # extended snapshot "Key=value Key=value" in the last column
+            if len(row) > 2 + len(keys) and row[-1]:
+                values.update(item.split("=", 1) for item in row[-1].split(" "))
+            traces.setdefault(row[1], []).append(values)
+    return traces
+
+
+def benchmark_deadband(args):
+    """
+    Sends trace (args.trace or synthetic idle device) through client DeadbandFilter
+    and server SeriesReconstructor. Reports reduction of sent bytes and messages (server
+    decode calls) and the worst reconstruction error. Budget: no rebuilt value further
+    than its tolerance from the real one.
+
+    Returns:
+        passed(bool): True if reconstruction error is within tolerances
+    """
+    import client
+    import server
+
+    traces = load_trace(args.trace) if args.trace else synthetic_idle_trace(3600)
+    batch_values = client.TCPClient.batch_values
+
+    raw_bytes = filtered_bytes = raw_messages = filtered_messages = 0
+    worst_error = {}
+    passed = True
+
+    for device_id, trace in traces.items():
+        deadband = client.DeadbandFilter()
+        reconstructor = server.SeriesReconstructor()
+        rebuilt = []
+
+        for values in trace:
+            raw_bytes += len(batch_values(values)) + 1
+            raw_messages += 1
+
+            filtered = deadband.filter(values)
+            if filtered:
+                message = batch_values(filtered)
+                filtered_bytes += len(message) + 1
+                filtered_messages += 1
+                rebuilt += reconstructor.reconstruct(server.TCPServer.retrieve_values(message))
+
+        # samples after the last message are rebuilt by the next one, compare what is rebuilt
+        for values, rebuilt_values in zip(trace, rebuilt):
+            for key, value in values.items():
+                error = abs(float(value) - float(rebuilt_values[key]))
+                worst_error[key] = max(worst_error.get(key, 0.0), error)
+                if error > deadband.tolerance_of(key) + 1e-9:
+                    passed = False
+
+    print("deadband: devices={} samples={} bytes {} -> {} ({:.1f}x) messages {} -> {} ({:.1f}x)".format(
+        len(traces), raw_messages, raw_bytes, filtered_bytes, raw_bytes / max(filtered_bytes, 1),
+        raw_messages, filtered_messages, raw_messages / max(filtered_messages, 1)))
+    tolerances = client.DeadbandFilter().tolerance_of
+    for key, error in sorted(worst_error.items()):
+        print("    {}: max error {:.4f} (tolerance {})".format(key, error, tolerances(key)))
+    return passed
+
+
+def start_server_process(port, *options):
+    """
+    Starts headless server.py without MAC lookup on localhost and waits until it accepts
+    connections.
+
+    Attributes:
+        port(int): port of the server
+        options(tuple(str)): additional server.py options
+
+    Returns:
+        process(subprocess.Popen): started server
+    """
+    server_script = os.path.join(os.path.dirname(os.path.realpath(__file__)), "server.py")
+    process = subprocess.Popen(
+        [sys.executable, server_script, "-i", "127.0.0.1", "-p", str(port), "-b", "4096",
+         "--headless", "--no_mac_lookup"] + list(options),
+        stdout=subprocess.DEVNULL
+    )
+
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return process
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("server.py on port {} has not started".format(port))
+
+
+def free_port():
+    """
+    Returns:
+        port(int): port, which is currently not used on localhost
+    """
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def benchmark_relay(args):
+    """
+    Runs central server and two relays as separate server.py processes on one box
+    (needs root, like server.py itself). args.devices simulated devices connect to the
+    relays and send args.iterations samples each. Central server is started only after
+    half of the samples have been sent, so that relays have to buffer them. Budget:
+    every sample reaches central CSV output within 30 seconds.
+
+    Returns:
+        passed(bool): True if all samples have been delivered
+    """
+    import client
+
+    central_port = free_port()
+    relay_ports = (free_port(), free_port())
+    output = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+    output.close()
+    processes = []
+
+    try:
+        for relay_port in relay_ports:
+            processes.append(start_server_process(
+                relay_port, "--upstream", "127.0.0.1:{}".format(central_port)))
+
+        devices = []
+        for device in range(args.devices):
+            connection = client.TCPClient(("127.0.0.1", relay_ports[device % len(relay_ports)]), 4096)
+            connection.handshake("bench-{}".format(device), {})
+            devices.append((connection, client.DeadbandFilter(heartbeat=1)))
+
+        start = time.perf_counter()
+        for sample in range(args.iterations):
+            if sample == args.iterations // 2:
+                processes.append(start_server_process(central_port, "--output", output.name))
+
+            for connection, deadband in devices:
+                values = connection.collect_device_values(
+                    str(sample % 100), str(sample * 2), "45.0", "600000000", ("0", "0"))
+                connection.encode_and_send_data(connection.batch_values(deadband.filter(values)))
+
+        expected = args.devices * args.iterations
+        delivered = 0
+        while time.perf_counter() - start < 30.0:
+            with open(output.name) as delivered_file:
+                delivered = sum(1 for _ in delivered_file)
+            if delivered >= expected:
+                break
+            time.sleep(0.2)
+        elapsed = time.perf_counter() - start
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
+        os.remove(output.name)
+
+    print("relay: devices={} samples={} delivered={} in {:.1f} s ({:.0f} samples/s)".format(
+        args.devices, expected, delivered, elapsed, delivered / elapsed))
+    return delivered == expected
+
+
+def benchmark_system_snapshot(args):
+    """
+    Takes args.iterations * 100 snapshots with client SystemSnapshot. Budget: 1 ms per
+    snapshot on RPi 3, on faster machines measured time is proportionally lower.
+
+    Returns:
+        passed(bool): True if the 99th percentile is within budget
+    """
+    import client
+
+    snapshot = client.SystemSnapshot()
+    take_times = []
+    for _ in range(args.iterations * 100):
+        start = time.perf_counter()
+        snapshot.take()
+        take_times.append(time.perf_counter() - start)
+
+    take_times.sort()
+    median_us = take_times[len(take_times) // 2] * 1e6
+    p99_us = take_times[int(len(take_times) * 0.99)] * 1e6
+    print("system_snapshot: keys={} snapshots={} median={:.1f} us p99={:.1f} us".format(
+        len(snapshot.keys), len(take_times), median_us, p99_us))
+    return p99_us < 1000.0
+
+
+BENCHMARKS = {
+    'snapshot': benchmark_system_snapshot,
+    'relay': benchmark_relay,
+    'deadband': benchmark_deadband,
+    'cold_start': benchmark_client_cold_start,
+    'fleet': benchmark_fleet_plotter,
+}
+
+
+if __name__ == "__main__":
+    args = ArgParser().args
+    exit(0 if BENCHMARKS[args.benchmark](args) else 1)
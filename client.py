@@ -6,9 +6,17 @@ Cracow, 14.01.2021
 
 """
 
+import threading
 import argparse
+import shutil
 import socket
+import signal
+import struct
+import array
+import json
+import math
 import time
+import uuid
 import os
 import re
 
@@ -29,6 +37,14 @@ class ArgParser(object):
         parser.add_argument('-p', '--port', help='Server Ipv4 port', type=int, required=True)
         parser.add_argument('-b', '--buffer', help='Packet size', type=int, required=True)
         parser.add_argument('-t', '--transmit_time', help='Transmit time on iperf', type=int, required=True)
+        parser.add_argument('-I', '--iperf_interval', help='Seconds between iperf runs, 0 runs it only on SIGUSR1',
+                            type=float, default=600.0)
+        parser.add_argument('-n', '--net_interval', help='Sampling period of /proc/net/dev', type=float, default=0.5)
+        parser.add_argument('-r', '--reconnect_delay', help='Seconds between reconnect attempts', type=float, default=5.0)
+        parser.add_argument('-H', '--heartbeat', help='Send all values every N samples, 1 sends every sample',
+                            type=int, default=30)
+        parser.add_argument('-T', '--tolerance', help='Deadband of the metric, e.g. CPU_Usage=5, can be repeated',
+                            type=str, action='append', default=[])
         self.args = parser.parse_args()
 
     def get_server_data(self):
@@ -52,53 +68,198 @@ class ArgParser(object):
         """
         return self.args.transmit_time
 
+    def get_iperf_interval(self):
+        """
+        Returns:
+            iperf_interval(float): seconds between iperf runs, 0 means only on demand
+        """
+        return self.args.iperf_interval
+
+    def get_net_interval(self):
+        """
+        Returns:
+            net_interval(float): sampling period of network counters in seconds
+        """
+        return self.args.net_interval
+
+    def get_reconnect_delay(self):
+        """
+        Returns:
+            reconnect_delay(float): seconds between reconnect attempts
+        """
+        return self.args.reconnect_delay
+
+    def get_heartbeat(self):
+        """
+        Returns:
+            heartbeat(int): number of samples between sending all values
+        """
+        return self.args.heartbeat
+
+    def get_tolerances(self):
+        """
+        Returns:
+            tolerances(dict(str, float)): metric key with its deadband tolerance
+        """
+        tolerances = {}
+        for tolerance in self.args.tolerance:
+            key, value = tolerance.split("=", 1)
+            tolerances[key] = float(value)
+        return tolerances
+
 
 class LinuxDependencies(object):
+    """
+    LinuxDependencies resolves external programs used by the client without forking
+    any process. Resolved paths are cached in memory and on disk, so that the next start
+    only has to check whether cached paths still exist. Missing programs are not
+    installed, NativeCmd readers are used instead (see get_metric_backends()).
+    """
+
+    cache_file = os.path.join(os.path.expanduser("~"), ".cache", "rpi_parameters_analyzer", "dependencies.json")
+    programs = ("vcgencmd", "iperf3")
+    __resolved = None
 
     @staticmethod
-    def __is_installed(program):
-        if os.path.exists("/bin/{}".format(program)):
-            return True
-        else:
-            return False
+    def __load_cache():
+        """
+        Loads cached paths. Cache is valid only for the same PATH variable.
+
+        Returns:
+            resolved(dict(str, str)): program name with its path or None if missing
+        """
+        try:
+            with open(LinuxDependencies.cache_file) as cache:
+                content = json.load(cache)
+        except (OSError, ValueError):
+            return {}
+
+        if content.get("PATH") != os.environ.get("PATH"):
+            return {}
+        return content.get("programs", {})
 
     @staticmethod
-    def __install_program(program, program_to_check=None):
-        os.system("sudo apt-get -y install --assume-yes {}".format(program))
-        
-        if program_to_check:
-            program = program_to_check
+    def __save_cache(resolved):
+        """
+        Saves resolved paths to the cache file. Failures are not fatal.
 
-        if LinuxDependencies.__is_installed(program):
-            print("Installation complete - {}!".format(program))
-        else:
-            print("Installation incomplete, exitting...")
-            exit(0)
+        Attributes:
+            resolved(dict(str, str)): program name with its path or None if missing
+        """
+        try:
+            os.makedirs(os.path.dirname(LinuxDependencies.cache_file), exist_ok=True)
+            with open(LinuxDependencies.cache_file, "w") as cache:
+                json.dump({"PATH": os.environ.get("PATH"), "programs": resolved}, cache)
+        except OSError:
+            print("Cannot save dependencies cache to {}".format(LinuxDependencies.cache_file))
 
     @staticmethod
-    def install_iperf3_if_not_already_installed():
-        if LinuxDependencies.__is_installed('iperf3'):
-            print("iperf3 is installed!")
-            return
-        else:
-            print('iperf3 cannot be found, installing...')
-            if LinuxDependencies.__is_installed("apt-get"):
-                LinuxDependencies.__install_program("iperf3")
-            else:
-                print("You're not using Debian linux distro, install manually! Exitting...")
-                exit(0)
-            
-    @staticmethod        
-    def install_iostat_if_not_already_installed():
-        if LinuxDependencies.__is_installed('iostat'):
-            print("iostat is installed!")
-        else:
-            print('iostat cannot be found, installing...')
-            if LinuxDependencies.__is_installed("apt-get"):
-                LinuxDependencies.__install_program("sysstat", "iostat")
-            else:
-                print("You're not using Debian linux distro, install manually! Exitting...")
-                exit(0)
+    def resolve_programs():
+        """
+        Resolves all needed programs. Cached path is reused if it is still executable,
+        otherwise program is looked up with shutil.which (missing programs are looked up
+        every time, so that freshly installed ones are detected).
+
+        Returns:
+            resolved(dict(str, str)): program name with its path or None if missing
+        """
+        if LinuxDependencies.__resolved is not None:
+            return LinuxDependencies.__resolved
+
+        cached = LinuxDependencies.__load_cache()
+        resolved = {}
+        for program in LinuxDependencies.programs:
+            path = cached.get(program)
+            if not path or not os.access(path, os.X_OK):
+                path = shutil.which(program)
+            resolved[program] = path
+
+        if resolved != cached:
+            LinuxDependencies.__save_cache(resolved)
+
+        LinuxDependencies.__resolved = resolved
+        return resolved
+
+    @staticmethod
+    def is_installed(program):
+        """
+        Attributes:
+            program(str): name of the program, e.g. iperf3
+
+        Returns:
+            installed(bool): True if program can be executed
+        """
+        return LinuxDependencies.resolve_programs().get(program) is not None
+
+    @staticmethod
+    def get_metric_backends():
+        """
+        Chooses backend for every metric. External programs are preferred if they are
+        present, otherwise native readers of /proc and /sys are used. None means that
+        metric is not available on this device.
+
+        Returns:
+            backends(dict(str, str)): metric name with the name of its backend
+        """
+        is_installed = LinuxDependencies.is_installed
+        backends = {
+            # iostat -c reports only average since boot, /proc/stat deltas are always used
+            "cpu_usage": "proc_stat",
+            "uptime": "proc_uptime",
+            "temperature": "vcgencmd" if is_installed("vcgencmd") else None,
+            "clock_arm": "vcgencmd" if is_installed("vcgencmd") else None,
+            "bitrate": "iperf3" if is_installed("iperf3") else None,
+        }
+
+        if backends["temperature"] is None and os.path.exists(NativeCmd.thermal_zone_file):
+            backends["temperature"] = "thermal_zone"
+        if backends["clock_arm"] is None and os.path.exists(NativeCmd.cpu_freq_file):
+            backends["clock_arm"] = "cpufreq"
+
+        return backends
+
+    @staticmethod
+    def print_metric_backends(backends):
+        """
+        Prints which backend is active for every metric.
+
+        Attributes:
+            backends(dict(str, str)): metric name with the name of its backend
+        """
+        for metric, backend in backends.items():
+            print("{}: {}".format(metric, backend if backend else "unavailable, sending nan"))
+
+
+class DeviceIdentity(object):
+    """
+    DeviceIdentity provides identifier of the device, which does not change between
+    restarts and reconnects. Identifier is generated once and stored in device_id_file.
+    """
+
+    device_id_file = os.path.join(os.path.dirname(LinuxDependencies.cache_file), "device_id")
+
+    @staticmethod
+    def get_device_id():
+        """
+        Returns:
+            device_id(str): persistent device identifier
+        """
+        try:
+            with open(DeviceIdentity.device_id_file) as f:
+                device_id = f.read().strip()
+            if device_id:
+                return device_id
+        except OSError:
+            pass
+
+        device_id = "{}-{}".format(socket.gethostname(), uuid.uuid4().hex[:12])
+        try:
+            os.makedirs(os.path.dirname(DeviceIdentity.device_id_file), exist_ok=True)
+            with open(DeviceIdentity.device_id_file, "w") as f:
+                f.write(device_id)
+        except OSError:
+            print("Cannot save device id to {}, it will change after restart".format(DeviceIdentity.device_id_file))
+        return device_id
 
 
 class TCPClient(object):
@@ -107,6 +268,8 @@ class TCPClient(object):
     responsible for batching data in order to send only one batched packet.
     """
 
+    protocol_version = 1
+
     def __init__(self, server_addr, buffer_size):
         """
         Creates socket and connects to the server. After constructor call you can
@@ -128,13 +291,14 @@ class TCPClient(object):
 
     def encode_and_send_data(self, data):
         """
-        Encodes and sends to the server given data.
+        Encodes and sends to the server given data. Every message ends with a new line,
+        so that server can split messages merged by TCP.
 
         Attributes:
             data(str): data that will be encoded and sent to server
         """
-        ready_to_send_data = data.encode("utf8")
-        self.client_socket.send(ready_to_send_data)
+        ready_to_send_data = (data + "\n").encode("utf8")
+        self.client_socket.sendall(ready_to_send_data)
 
     def receive_and_decode_data(self):
         """
@@ -147,10 +311,56 @@ class TCPClient(object):
         decoded_data = received_data.decode("utf8")
         return decoded_data
 
-    def batch_device_data(self, cpu_usage, uptime, temperature, clock_arm, bitrate):
+    def handshake(self, device_id, capabilities, session_token=None):
         """
-        Batches all collected device data, so that it can be encoded and sent. You can just
-        call encode_and_send_data() afterwards with return value of this method.
+        Introduces device to the server and receives its configuration in one round trip.
+        Session token received from the previous connection lets the server reuse state
+        of the device instead of recomputing it.
+
+        Attributes:
+            device_id(str): persistent device identifier, see DeviceIdentity
+            capabilities(dict(str, str)): metric name with the name of its backend
+            session_token(str): token from the previous handshake or None
+
+        Returns:
+            config(dict(str, str)): server configuration, contains at least Session and Interval
+        """
+        hello = "HELLO: {} DeviceId: {} Session: {} Capabilities: {}".format(
+            TCPClient.protocol_version, device_id, session_token or "-",
+            ",".join("{}={}".format(metric, backend) for metric, backend in capabilities.items())
+        )
+        self.encode_and_send_data(hello)
+
+        welcome = self.receive_and_decode_data()
+        if not welcome.startswith("WELCOME:"):
+            raise ConnectionResetError("Unexpected handshake reply: {}".format(welcome))
+        return dict(re.findall(r"(\S+): (\S+)", welcome))
+
+    def get_tcp_info(self):
+        """
+        Reads kernel TCP statistics of the connection with the server (Linux only).
+
+        Returns:
+            tcp_info(dict(str, float)): smoothed round trip time in ms and total number
+                of retransmitted segments, None if TCP_INFO is not supported
+        """
+        if not hasattr(socket, "TCP_INFO"):
+            return None
+
+        # struct tcp_info: 8 x u8, then u32 fields, tcpi_rtt is 16th, tcpi_total_retrans 24th
+        tcp_info_format = "8B24I"
+        info = self.client_socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, struct.calcsize(tcp_info_format))
+        if len(info) < struct.calcsize(tcp_info_format):
+            return None
+
+        fields = struct.unpack(tcp_info_format, info)
+        return {"Rtt": fields[8 + 15] / 1000.0, "Retrans": fields[8 + 23]}
+
+    def collect_device_values(self, cpu_usage, uptime, temperature, clock_arm, bitrate, network=None, tcp_info=None,
+                              snapshot=None):
+        """
+        Collects all device data into one dictionary with keys used in batched data.
+        Time of the sample is added, so that server stores it instead of arrival time.
 
         Attributes:
             cpu_usage(str): cpu usage retrieved from bash
@@ -158,18 +368,46 @@ class TCPClient(object):
             temperature(str): device temperature retrieved from bash
             clock_arm(str): ARM clock retrieved from bash
             bitrate(tuple(str, str)): sender and receiver iperf bitrate retrieved from bash
+            network(dict(str, dict(str, float))): interface statistics from NetDevMonitor.collect()
+            tcp_info(dict(str, float)): connection statistics from get_tcp_info()
+            snapshot(SystemSnapshot): extended system statistics, see SystemSnapshot.take()
+
+        Returns:
+            values(dict(str, str)): key with its value, ready to be passed to batch_values()
+        """
+        values = {
+            "Time": "{:.3f}".format(time.time()),
+            "CPU_Usage": cpu_usage,
+            "Uptime": uptime,
+            "Temperature": temperature,
+            "ClockArm": clock_arm,
+            "SendBitrate": bitrate[0],
+            "RecvBitrate": bitrate[1],
+        }
+
+        for interface, statistics in (network or {}).items():
+            for name, value in statistics.items():
+                values["Net{}[{}]".format(name, interface)] = "{:.3f}".format(value)
+        for name, value in (tcp_info or {}).items():
+            values["Tcp{}".format(name)] = str(value)
+        if snapshot is not None:
+            for key, value in snapshot.items():
+                values[key] = "{:.2f}".format(value)
+
+        return values
+
+    @staticmethod
+    def batch_values(values):
+        """
+        Batches collected values, so that they can be encoded and sent.
+
+        Attributes:
+            values(dict(str, str)): key with its value
 
         Returns:
             batched(str): ready to send batched data
         """
-        batched = ""
-        batched += "CPU_Usage: {} ".format(cpu_usage)
-        batched += "Uptime: {} ".format(uptime)
-        batched += "Temperature: {} ".format(temperature)
-        batched += "ClockArm: {} ".format(clock_arm)
-        batched += "SendBitrate: {} ".format(bitrate[0])
-        batched += "RecvBitrate: {}".format(bitrate[1])
-        return batched
+        return " ".join("{}: {}".format(key, value) for key, value in values.items())
 
 
 class BashCmd(object):
@@ -209,32 +447,6 @@ class BashCmd(object):
         output_lst = re.findall(double_values_in, output)
         return output_lst[0]
 
-    @staticmethod
-    def get_cpu_usage():
-        """
-        Method returns cpu usage of the device.
-
-        Returns:
-            cpu_usage(str)
-        """
-        cpu_usage_cmd = "iostat -c | awk '{print $3}' | sed '4q;d'"
-        output = BashCmd.__execute_command(cpu_usage_cmd)
-        cpu_usage = BashCmd.__get_first_double_value_from(output)
-        return cpu_usage
-    
-    @staticmethod
-    def get_device_uptime():
-        """
-        Method returns device uptime, how much time device is ON.
-
-        Returns:
-            system_uptime_seconds(str)
-        """
-        proc_uptime_cmd = "cat /proc/uptime"
-        output = BashCmd.__execute_command(proc_uptime_cmd)
-        system_uptime_seconds = BashCmd.__get_first_double_value_from(output)
-        return system_uptime_seconds
-
     @staticmethod
     def get_device_temperature():
         """
@@ -288,6 +500,619 @@ class BashCmd(object):
         return bitrate
     
 
+class NativeCmd(object):
+    """
+    NativeCmd is a class, which contains only static methods used to retrieve
+    the same information as BashCmd, but directly from /proc and /sys files. It is used
+    when needed program is not installed and it does not fork any process.
+    """
+
+    thermal_zone_file = "/sys/class/thermal/thermal_zone0/temp"
+    cpu_freq_file = "/sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq"
+    __previous_cpu_times = (0, 0)
+
+    @staticmethod
+    def __read_file(path):
+        """
+        Attributes:
+            path(str): path to the file
+
+        Returns:
+            content(str): content of the file
+        """
+        with open(path) as f:
+            return f.read()
+
+    @staticmethod
+    def get_cpu_usage():
+        """
+        Method returns cpu usage of the device since previous call (since boot on the
+        first call, the same as iostat does).
+
+        Returns:
+            cpu_usage(str)
+        """
+        cpu_line = NativeCmd.__read_file("/proc/stat").split("\n", 1)[0]
+        times = [int(value) for value in cpu_line.split()[1:9]]
+        idle = times[3] + times[4]
+        total = sum(times)
+
+        previous_idle, previous_total = NativeCmd.__previous_cpu_times
+        NativeCmd.__previous_cpu_times = (idle, total)
+
+        total_delta = total - previous_total
+        if total_delta <= 0:
+            return "0.00"
+        return "{:.2f}".format(100.0 * (total_delta - (idle - previous_idle)) / total_delta)
+
+    @staticmethod
+    def get_device_uptime():
+        """
+        Method returns device uptime, how much time device is ON.
+
+        Returns:
+            system_uptime_seconds(str)
+        """
+        return NativeCmd.__read_file("/proc/uptime").split()[0]
+
+    @staticmethod
+    def get_device_temperature():
+        """
+        Returns device temperature read from the first thermal zone.
+
+        Returns:
+            temperature(str): temperature in celsius
+        """
+        millidegrees = int(NativeCmd.__read_file(NativeCmd.thermal_zone_file))
+        return "{:.1f}".format(millidegrees / 1000.0)
+
+    @staticmethod
+    def get_clock_arm():
+        """
+        Returns current frequency of the first CPU core.
+
+        Returns:
+            clock_arm(str): clock in Hz
+        """
+        kilohertz = int(NativeCmd.__read_file(NativeCmd.cpu_freq_file))
+        return str(kilohertz * 1000)
+
+
+class MetricCollector(object):
+    """
+    MetricCollector calls proper BashCmd / NativeCmd method for every metric, depending
+    on backends chosen by LinuxDependencies.get_metric_backends().
+    """
+
+    def __init__(self, backends):
+        """
+        Chooses getter for every metric.
+
+        Attributes:
+            backends(dict(str, str)): metric name with the name of its backend
+        """
+        getters = {
+            "proc_stat": NativeCmd.get_cpu_usage,
+            "proc_uptime": NativeCmd.get_device_uptime,
+            "thermal_zone": NativeCmd.get_device_temperature,
+            "cpufreq": NativeCmd.get_clock_arm,
+        }
+        vcgencmd_getters = {
+            "temperature": BashCmd.get_device_temperature,
+            "clock_arm": BashCmd.get_clock_arm,
+        }
+
+        self.__getters = {}
+        for metric in ("cpu_usage", "uptime", "temperature", "clock_arm"):
+            backend = backends.get(metric)
+            if backend == "vcgencmd":
+                self.__getters[metric] = vcgencmd_getters[metric]
+            elif backend in getters:
+                self.__getters[metric] = getters[backend]
+            else:
+                # nan, so that missing metric cannot be confused with a real measurement
+                self.__getters[metric] = lambda: "nan"
+
+    def collect(self):
+        """
+        Returns:
+            metrics(dict(str, str)): current value of every metric, ready to be passed
+                to TCPClient.collect_device_values()
+        """
+        return {metric: getter() for metric, getter in self.__getters.items()}
+
+
+class NetDevMonitor(object):
+    """
+    NetDevMonitor is a passive alternative to iperf. It samples interface counters
+    from /proc/net/dev in a background thread and computes rx / tx rates, errors and
+    drops from counter deltas, so that measuring does not consume any bandwidth.
+    """
+
+    net_dev_file = "/proc/net/dev"
+    # bytes per second (10 Gbps), higher increase of the counter is not plausible
+    max_link_rate = 1.25e9
+
+    def __init__(self, interval=0.5, ignored_interfaces=("lo",)):
+        """
+        Reads initial counters. Call start() to begin sampling in the background.
+
+        Attributes:
+            interval(float): sampling period in seconds
+            ignored_interfaces(tuple(str)): interfaces, which are not reported
+        """
+        self.interval = interval
+        self.ignored_interfaces = ignored_interfaces
+        self.lock = threading.Lock()
+        self.previous_counters = NetDevMonitor.read_counters()
+        self.previous_sample_time = time.monotonic()
+        self.last_collect_time = self.previous_sample_time
+        self.accumulated = {}
+
+    @staticmethod
+    def read_counters():
+        """
+        Reads counters of all interfaces.
+
+        Returns:
+            counters(dict(str, tuple(int))): interface name with its
+                (rx_bytes, tx_bytes, rx_errors + tx_errors, rx_drops + tx_drops)
+        """
+        with open(NetDevMonitor.net_dev_file) as net_dev:
+            lines = net_dev.readlines()[2:]
+
+        counters = {}
+        for line in lines:
+            interface, values = line.split(":", 1)
+            values = values.split()
+            counters[interface.strip()] = (
+                int(values[0]), int(values[8]),
+                int(values[2]) + int(values[10]), int(values[3]) + int(values[11])
+            )
+        return counters
+
+    @staticmethod
+    def __delta(current, previous, max_delta):
+        """
+        Returns difference of two counter values. Decrease means either wraparound
+        (32-bit counters are still used by some drivers) or counter reset, e.g. when
+        interface goes down and up. It is treated as wraparound only if the previous
+        value was close enough to 2**32 / 2**64, that the increase is plausible.
+        Implausible increases are ignored.
+
+        Attributes:
+            current(int): current counter value
+            previous(int): previous counter value
+            max_delta(float): highest plausible increase since previous sample
+
+        Returns:
+            delta(int): counter increase
+        """
+        delta = current - previous
+        if delta >= 0:
+            return delta if delta <= max_delta else 0
+
+        for counter_range in (2 ** 32, 2 ** 64):
+            wrapped = counter_range - previous + current
+            if counter_range // 2 <= previous < counter_range and wrapped <= max_delta:
+                return wrapped
+
+        # counter reset, it has counted from 0 since then
+        return current if current <= max_delta else 0
+
+    def sample(self):
+        """
+        Reads counters and accumulates their increase since previous sample, also
+        remembers the highest rx / tx rate seen since the last collect(). Counters are
+        read under the lock, so that samples of both threads are applied in order.
+        """
+        with self.lock:
+            counters = NetDevMonitor.read_counters()
+            now = time.monotonic()
+            elapsed = max(now - self.previous_sample_time, 1e-6)
+
+            for interface, values in counters.items():
+                if interface in self.ignored_interfaces:
+                    continue
+
+                previous = self.previous_counters.get(interface)
+                if previous is None:
+                    continue
+
+                max_delta = NetDevMonitor.max_link_rate * elapsed
+                rx, tx, errors, drops = [NetDevMonitor.__delta(c, p, max_delta) for c, p in zip(values, previous)]
+                accumulated = self.accumulated.setdefault(interface, [0, 0, 0, 0, 0.0, 0.0])
+                accumulated[0] += rx
+                accumulated[1] += tx
+                accumulated[2] += errors
+                accumulated[3] += drops
+                accumulated[4] = max(accumulated[4], rx / elapsed)
+                accumulated[5] = max(accumulated[5], tx / elapsed)
+
+            self.previous_counters = counters
+            self.previous_sample_time = now
+
+    def __run(self):
+        """
+        Samples counters until the program ends.
+        """
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+
+    def start(self):
+        """
+        Starts background sampling thread.
+        """
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def collect(self):
+        """
+        Returns statistics since the previous call and resets them. Rates are in Mbps.
+
+        Returns:
+            network(dict(str, dict(str, float))): interface name with its average rx / tx
+                rate, peak rx / tx rate, number of errors and drops
+        """
+        self.sample()
+
+        with self.lock:
+            now = time.monotonic()
+            elapsed = max(now - self.last_collect_time, 1e-6)
+            self.last_collect_time = now
+
+            network = {}
+            for interface, (rx, tx, errors, drops, rx_peak, tx_peak) in self.accumulated.items():
+                network[interface] = {
+                    "Rx": rx * 8 / elapsed / 1e6, "Tx": tx * 8 / elapsed / 1e6,
+                    "RxPeak": rx_peak * 8 / 1e6, "TxPeak": tx_peak * 8 / 1e6,
+                    "Errors": errors, "Drops": drops,
+                }
+            self.accumulated = {}
+
+        return network
+
+
+class SystemSnapshot(object):
+    """
+    SystemSnapshot reads per-core cpu load, cpu I/O wait, memory, disk I/O, pressure
+    stall information and RPi throttling flags in one pass. Files are opened once and
+    re-read with os.pread(), values are stored in preallocated array, so that taking
+    snapshot does not fork, open files nor allocate the record. Keys are chosen once
+    at start from what the device has, e.g. CpuCore[0] or DiskUtil[mmcblk0].
+    """
+
+    stat_file = "/proc/stat"
+    meminfo_file = "/proc/meminfo"
+    diskstats_file = "/proc/diskstats"
+    pressure_files = (
+        ("PressureCpu", "/proc/pressure/cpu"),
+        ("PressureMemory", "/proc/pressure/memory"),
+        ("PressureIo", "/proc/pressure/io"),
+    )
+    throttled_file = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+    hwmon_dir = "/sys/class/hwmon"
+    ignored_disks = ("loop", "ram")
+
+    def __init__(self):
+        """
+        Chooses keys of the snapshot, allocates record and takes the first snapshot,
+        so that rates of the next one are computed from real deltas.
+        """
+        self.fds = {}
+
+        stat_lines = self.__read(SystemSnapshot.stat_file).split(b"\n")
+        self.cores = sum(1 for line in stat_lines if line[:3] == b"cpu" and line[3:4].isdigit())
+
+        self.disks = []
+        for line in self.__read(SystemSnapshot.diskstats_file).split(b"\n"):
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+            disk = fields[2].decode()
+            if os.path.exists("/sys/block/{}".format(disk)) and not disk.startswith(SystemSnapshot.ignored_disks):
+                self.disks.append(disk)
+        self.disk_rows = {disk.encode(): row for row, disk in enumerate(self.disks)}
+
+        self.pressure_files = [
+            (key, path) for key, path in SystemSnapshot.pressure_files if os.path.exists(path)
+        ]
+        self.throttled_source = self.__find_throttled_source()
+
+        keys = ["CpuIowait"]
+        keys += ["CpuCore[{}]".format(core) for core in range(self.cores)]
+        keys += ["MemAvailable", "MemUsedPercent"]
+        for disk in self.disks:
+            keys += ["DiskUtil[{}]".format(disk), "DiskRead[{}]".format(disk), "DiskWrite[{}]".format(disk)]
+        keys += [key for key, _ in self.pressure_files]
+        if self.throttled_source:
+            keys.append("Throttled")
+
+        self.keys = tuple(keys)
+        self.values = array.array("d", bytes(8 * len(self.keys)))
+        self.disk_offset = 3 + self.cores
+        self.pressure_offset = self.disk_offset + 3 * len(self.disks)
+
+        # (idle, total) of all cores and the aggregate, (read, written, io_ticks) of disks
+        self.previous_cpu = array.array("d", bytes(8 * 2 * (self.cores + 1)))
+        self.previous_disks = array.array("d", bytes(8 * 3 * len(self.disks)))
+        self.previous_iowait = 0.0
+        self.previous_time = time.monotonic()
+        self.take()
+
+    def __find_throttled_source(self):
+        """
+        Finds file with throttling flags: firmware get_throttled, otherwise under-voltage
+        alarm of rpi_volt hwmon (bit 0 only). vcgencmd get_throttled is not used, fork
+        per snapshot would be too slow.
+
+        Returns:
+            source(tuple(str, bool)): path and True if it contains hex flags, None if not found
+        """
+        if os.path.exists(SystemSnapshot.throttled_file):
+            return (SystemSnapshot.throttled_file, True)
+
+        if os.path.isdir(SystemSnapshot.hwmon_dir):
+            for hwmon in sorted(os.listdir(SystemSnapshot.hwmon_dir)):
+                hwmon_path = os.path.join(SystemSnapshot.hwmon_dir, hwmon)
+                try:
+                    with open(os.path.join(hwmon_path, "name")) as name:
+                        if name.read().strip() != "rpi_volt":
+                            continue
+                except OSError:
+                    continue
+                alarm = os.path.join(hwmon_path, "in0_lcrit_alarm")
+                if os.path.exists(alarm):
+                    return (alarm, False)
+        return None
+
+    def __read(self, path):
+        """
+        Reads whole file, file descriptor is opened only on the first call.
+
+        Attributes:
+            path(str): path to the file
+
+        Returns:
+            content(bytes): content of the file
+        """
+        fd = self.fds.get(path)
+        if fd is None:
+            fd = self.fds[path] = os.open(path, os.O_RDONLY)
+        return os.pread(fd, 65536, 0)
+
+    def take(self):
+        """
+        Takes new snapshot, rates and loads are computed since the previous one.
+
+        Returns:
+            snapshot(SystemSnapshot): self, so that items() can be called directly
+        """
+        values = self.values
+        now = time.monotonic()
+        elapsed = max(now - self.previous_time, 1e-6)
+        self.previous_time = now
+
+        # aggregate line, then one line per core
+        stat_lines = self.__read(SystemSnapshot.stat_file).split(b"\n", self.cores + 1)
+        previous_cpu = self.previous_cpu
+        for row in range(self.cores + 1):
+            fields = stat_lines[row].split(None, 9)
+            iowait = float(fields[5])
+            idle = float(fields[4]) + iowait
+            total = idle + float(fields[1]) + float(fields[2]) + float(fields[3]) \
+                + float(fields[6]) + float(fields[7]) + float(fields[8])
+
+            total_delta = total - previous_cpu[2 * row + 1]
+            busy = 100.0 * (total_delta - (idle - previous_cpu[2 * row])) / total_delta if total_delta > 0 else 0.0
+            previous_cpu[2 * row] = idle
+            previous_cpu[2 * row + 1] = total
+
+            if row == 0:
+                values[0] = 100.0 * (iowait - self.previous_iowait) / total_delta if total_delta > 0 else 0.0
+                self.previous_iowait = iowait
+            else:
+                values[row] = busy
+
+        mem_total = mem_available = 0.0
+        for line in self.__read(SystemSnapshot.meminfo_file).split(b"\n", 3)[:3]:
+            if line.startswith(b"MemTotal:"):
+                mem_total = float(line.split()[1])
+            elif line.startswith(b"MemAvailable:"):
+                mem_available = float(line.split()[1])
+        values[self.cores + 1] = mem_available / 1024.0
+        values[self.cores + 2] = 100.0 * (mem_total - mem_available) / mem_total if mem_total else 0.0
+
+        if self.disks:
+            previous_disks = self.previous_disks
+            for line in self.__read(SystemSnapshot.diskstats_file).split(b"\n"):
+                fields = line.split(None, 13)
+                if len(fields) < 13:
+                    continue
+                row = self.disk_rows.get(fields[2])
+                if row is None:
+                    continue
+
+                read, written, io_ticks = float(fields[5]), float(fields[9]), float(fields[12])
+                offset = self.disk_offset + 3 * row
+                # sectors have 512 B, rates are in kB/s, io_ticks in ms
+                values[offset] = min(100.0, (io_ticks - previous_disks[3 * row + 2]) / elapsed / 10.0)
+                values[offset + 1] = (read - previous_disks[3 * row]) / 2.0 / elapsed
+                values[offset + 2] = (written - previous_disks[3 * row + 1]) / 2.0 / elapsed
+                previous_disks[3 * row] = read
+                previous_disks[3 * row + 1] = written
+                previous_disks[3 * row + 2] = io_ticks
+
+        offset = self.pressure_offset
+        for _, path in self.pressure_files:
+            # "some avg10=0.00 avg60=0.00 avg300=0.00 total=0"
+            values[offset] = float(self.__read(path).split(None, 2)[1][6:])
+            offset += 1
+
+        if self.throttled_source:
+            path, hexadecimal = self.throttled_source
+            content = self.__read(path).strip()
+            values[offset] = float(int(content, 16) if hexadecimal else int(content))
+
+        return self
+
+    def items(self):
+        """
+        Returns:
+            items(iterator(tuple(str, float))): key with its value from the last snapshot
+        """
+        return zip(self.keys, self.values)
+
+
+class DeadbandFilter(object):
+    """
+    DeadbandFilter sends value of the metric only when it differs from the value
+    predicted by the server by more than metric tolerance (report by exception).
+    Prediction is the last sent value, for metrics in linear_keys (e.g. uptime)
+    it is extrapolated with the slope per sample sent together with the value, so that
+    e.g. time of the sample is sent only when sampling interval drifts.
+    Every message has sequence number, so that server can rebuild skipped samples,
+    and every heartbeat samples all values are sent. First message after reset() has
+    Resync key, so that server does not rebuild samples lost before. Sent values are
+    never further than tolerance from the real ones, the same holds for server
+    reconstruction.
+    """
+
+    default_tolerances = {
+        "Time": 0.5,
+        "CPU_Usage": 2.0,
+        "Uptime": 1.0,
+        "Temperature": 0.5,
+        "ClockArm": 0.0,
+        "SendBitrate": 0.0,
+        "RecvBitrate": 0.0,
+        "NetRx": 0.05,
+        "NetTx": 0.05,
+        "NetRxPeak": 0.1,
+        "NetTxPeak": 0.1,
+        "NetErrors": 0.0,
+        "NetDrops": 0.0,
+        "TcpRtt": 1.0,
+        "TcpRetrans": 0.0,
+        "CpuIowait": 1.0,
+        "CpuCore": 5.0,
+        "MemAvailable": 8.0,
+        "MemUsedPercent": 0.5,
+        "DiskUtil": 2.0,
+        "DiskRead": 16.0,
+        "DiskWrite": 16.0,
+        "PressureCpu": 1.0,
+        "PressureMemory": 1.0,
+        "PressureIo": 1.0,
+        "Throttled": 0.0,
+    }
+    linear_keys = ("Time", "Uptime")
+
+    def __init__(self, tolerances=None, heartbeat=30):
+        """
+        Attributes:
+            tolerances(dict(str, float)): overrides of default_tolerances, key of the
+                network metric is given without interface, e.g. NetRx
+            heartbeat(int): all values are sent every heartbeat samples, 1 disables filtering
+        """
+        self.tolerances = dict(DeadbandFilter.default_tolerances)
+        self.tolerances.update(tolerances or {})
+        self.heartbeat = heartbeat
+        self.seq = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets sent values, next filtered sample is sent as heartbeat with Resync key.
+        Call it after reconnect, sequence numbers continue.
+        """
+        self.predictors = {}
+        self.previous_values = {}
+        self.last_heartbeat_seq = None
+        self.resync = True
+
+    def tolerance_of(self, key):
+        """
+        Attributes:
+            key(str): key of the metric, e.g. NetRx[eth0]
+
+        Returns:
+            tolerance(float): allowed difference between real and predicted value
+        """
+        return self.tolerances.get(key.split("[", 1)[0], 0.0)
+
+    def __predict(self, key):
+        """
+        Attributes:
+            key(str): key of the metric
+
+        Returns:
+            predicted(float): value predicted for current sample, None if never sent
+        """
+        predictor = self.predictors.get(key)
+        if predictor is None:
+            return None
+        value, slope, seq = predictor
+        return value + slope * (self.seq - seq)
+
+    def __is_outside_deadband(self, current, predicted, key):
+        """
+        Attributes:
+            current(float): real value, nan if metric is unavailable
+            predicted(float): value predicted for current sample
+            key(str): key of the metric
+
+        Returns:
+            outside(bool): True if value has to be sent, change from / to nan is always sent
+        """
+        if math.isnan(current) or math.isnan(predicted):
+            return math.isnan(current) != math.isnan(predicted)
+        return abs(current - predicted) > self.tolerance_of(key)
+
+    def filter(self, values):
+        """
+        Chooses values, which have to be sent for current sample.
+
+        Attributes:
+            values(dict(str, str)): all collected values, see TCPClient.collect_device_values()
+
+        Returns:
+            filtered(dict(str, str)): values to send with Seq (and Heartbeat, Resync) keys,
+                None if nothing has to be sent
+        """
+        self.seq += 1
+        heartbeat = self.last_heartbeat_seq is None or self.seq - self.last_heartbeat_seq >= self.heartbeat
+
+        filtered = {"Seq": str(self.seq)}
+        if self.resync:
+            filtered["Resync"] = "1"
+            self.resync = False
+        if heartbeat:
+            filtered["Heartbeat"] = "1"
+            self.last_heartbeat_seq = self.seq
+            self.predictors = {}
+
+        for key, value in values.items():
+            current = float(value)
+            predicted = self.__predict(key)
+
+            if predicted is None or self.__is_outside_deadband(current, predicted, key):
+                slope = 0.0
+                previous = self.previous_values.get(key)
+                if key in DeadbandFilter.linear_keys and previous is not None:
+                    slope = current - previous
+                    filtered["Slope[{}]".format(key)] = repr(slope)
+
+                filtered[key] = value
+                self.predictors[key] = (current, slope, self.seq)
+
+            self.previous_values[key] = current
+
+        if len(filtered) == 1:
+            return None
+        return filtered
+
+
 class IperfFunctor(object):
     """
     IperfFunctor is a abstraction for iperf management on Linux. With this we can
@@ -353,12 +1178,17 @@ class IperfFunctor(object):
         deletes old log file, because it is not needed after parsing.
 
         Returns:
-            bitrate(tuple(str, str)): bitrate[0] stands for receiver bitrate, bitrate[1] for sender
+            bitrate(tuple(str, str)): bitrate[0] stands for receiver bitrate, bitrate[1] for sender,
+                nan if iperf has failed (e.g. host unreachable)
         """
         receiver_bitrate_type = "1"
         sender_bitrate_type = "2"
-        receiver_bitrate = BashCmd.get_bitrate_from_iperf_logs(self.logfile, receiver_bitrate_type)
-        sender_bitrate = BashCmd.get_bitrate_from_iperf_logs(self.logfile, sender_bitrate_type)
+        try:
+            receiver_bitrate = BashCmd.get_bitrate_from_iperf_logs(self.logfile, receiver_bitrate_type)
+            sender_bitrate = BashCmd.get_bitrate_from_iperf_logs(self.logfile, sender_bitrate_type)
+        except IndexError:
+            print("Cannot parse iperf logs {}, sending nan bitrate...".format(self.logfile))
+            receiver_bitrate, sender_bitrate = "nan", "nan"
 
         if os.path.exists(self.logfile):
             os.remove(self.logfile)
@@ -369,38 +1199,77 @@ class IperfFunctor(object):
 
 
 def main(args):
-    LinuxDependencies.install_iperf3_if_not_already_installed()
-    LinuxDependencies.install_iostat_if_not_already_installed()
+    backends = LinuxDependencies.get_metric_backends()
+    LinuxDependencies.print_metric_backends(backends)
+    collector = MetricCollector(backends)
+    snapshot = SystemSnapshot()
 
     iperf = IperfFunctor()
     iperf.time_to_transmit = args.get_transmit_time()
     iperf.interval = 2
     iperf.logfile = dir_path = os.path.dirname(os.path.realpath(__file__)) + "/logs.txt"
 
-    client = TCPClient(
-        server_addr=args.get_server_data(), 
-        buffer_size=args.get_buffer()
-    )
+    device_id = DeviceIdentity.get_device_id()
+    session_token = None
+
+    network_monitor = NetDevMonitor(interval=args.get_net_interval())
+    network_monitor.start()
 
-    data = input('Input some data: ')
-    client.encode_and_send_data(data)
+    # iperf floods the link, so it runs only every iperf_interval seconds or on SIGUSR1
+    iperf_requested = threading.Event()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: iperf_requested.set())
+    iperf_interval = args.get_iperf_interval()
+    last_iperf_run = None
 
-    data = client.receive_and_decode_data()
-    print("Received data: {}".format(data))
+    deadband = DeadbandFilter(tolerances=args.get_tolerances(), heartbeat=args.get_heartbeat())
+
+    # bitrate is sent one loop later, so that first sample does not wait for iperf
+    bitrate = ("nan", "nan")
 
     while True:
-        iperf.run()
-
-        data = client.batch_device_data(
-            cpu_usage=BashCmd.get_cpu_usage(), 
-            uptime=BashCmd.get_device_uptime(), 
-            temperature=BashCmd.get_device_temperature(), 
-            clock_arm=BashCmd.get_clock_arm(),
-            bitrate=iperf.parse_file()
-        )
-        print("Batched: {}".format(data))
-        client.encode_and_send_data(data)
-        time.sleep(2)
+        try:
+            client = TCPClient(
+                server_addr=args.get_server_data(), 
+                buffer_size=args.get_buffer()
+            )
+            config = client.handshake(device_id, backends, session_token)
+        except OSError as error:
+            # e.g. refused connection, unknown host name, unreachable network or timeout
+            print("Cannot connect to the server ({}), retrying in {}s...".format(error, args.get_reconnect_delay()))
+            time.sleep(args.get_reconnect_delay())
+            continue
+
+        session_token = config["Session"]
+        sample_interval = float(config.get("Interval", 2))
+        print("Connected as {}, session {}, interval {}s".format(device_id, session_token, sample_interval))
+        deadband.reset()
+
+        try:
+            while True:
+                values = client.collect_device_values(
+                    bitrate=bitrate,
+                    network=network_monitor.collect(),
+                    tcp_info=client.get_tcp_info(),
+                    snapshot=snapshot.take(),
+                    **collector.collect()
+                )
+                filtered = deadband.filter(values)
+                if filtered:
+                    data = client.batch_values(filtered)
+                    print("Batched: {}".format(data))
+                    client.encode_and_send_data(data)
+
+                iperf_due = iperf_interval > 0 and (last_iperf_run is None or time.monotonic() - last_iperf_run >= iperf_interval)
+                if backends["bitrate"] and (iperf_due or iperf_requested.is_set()):
+                    iperf_requested.clear()
+                    iperf.run()
+                    bitrate = iperf.parse_file()
+                    last_iperf_run = time.monotonic()
+                time.sleep(sample_interval)
+        except OSError as error:
+            print("Connection with the server lost ({}), reconnecting in {}s...".format(
+                error, args.get_reconnect_delay()))
+            time.sleep(args.get_reconnect_delay())
 
 
 if __name__ == "__main__":
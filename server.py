@@ -8,6 +8,7 @@ Cracow, 14.01.2021
 
 
 from scapy.all import ARP, Ether, srp
+from matplotlib.ticker import MaxNLocator
 import matplotlib.pyplot as plt
 import numpy as np
 import netifaces
@@ -16,7 +17,12 @@ import argparse
 import tkinter
 import socket
 import struct
+import collections
+import threading
+import secrets
 import fcntl
+import math
+import time
 import re
 import os
 
@@ -102,6 +108,14 @@ class ArgParser(object):
         parser.add_argument('-i', '--ip', help='Server Ipv4 address', type=str, required=True)
         parser.add_argument('-p', '--port', help='Server Ipv4 port', type=int, required=True)
         parser.add_argument('-b', '--buffer', help='Packet size', type=int, required=True)
+        parser.add_argument('-f', '--fps', help='Fleet dashboard frame rate', type=float, default=10.0)
+        parser.add_argument('-o', '--output', help='CSV file for received samples', type=str, default=None)
+        parser.add_argument('-t', '--sample_interval', help='Seconds between client samples', type=float, default=2.0)
+        parser.add_argument('-u', '--upstream', help='Relay mode, upstream server as ip:port', type=str, default=None)
+        parser.add_argument('--headless', help='Do not show fleet dashboard', action='store_true')
+        parser.add_argument('-v', '--verbose', help='Print every received sample', action='store_true')
+        parser.add_argument('--no_mac_lookup', help='Do not look up MAC address and vendor', action='store_true')
+        parser.add_argument('-s', '--stats_interval', help='Queue statistics print interval', type=float, default=10.0)
         self.args = parser.parse_args()
 
     def get_server_data(self):
@@ -118,51 +132,197 @@ class ArgParser(object):
         """
         return self.args.buffer
 
+    def get_fps(self):
+        """
+        Returns:
+            fps(float): frame rate of the fleet dashboard
+        """
+        return self.args.fps
+
+    def get_output_file(self):
+        """
+        Returns:
+            output_file(str): path of the CSV file for received samples or None
+        """
+        return self.args.output
+
+    def get_sample_interval(self):
+        """
+        Returns:
+            sample_interval(float): seconds between client samples, sent in handshake
+        """
+        return self.args.sample_interval
+
+    def get_upstream_data(self):
+        """
+        Returns:
+            upstream_data(tuple(str, int)): upstream ip address and port, None if relay mode is off
+        """
+        if not self.args.upstream:
+            return None
+        ip, port = self.args.upstream.rsplit(":", 1)
+        return (ip, int(port))
+
+    def is_headless(self):
+        """
+        Returns:
+            headless(bool): True if fleet dashboard should not be shown
+        """
+        return self.args.headless
+
+    def is_verbose(self):
+        """
+        Returns:
+            verbose(bool): True if every received sample should be printed
+        """
+        return self.args.verbose
+
+    def is_mac_lookup_enabled(self):
+        """
+        Returns:
+            mac_lookup(bool): True if MAC address and vendor of clients should be retrieved
+        """
+        return not self.args.no_mac_lookup
+
+    def get_stats_interval(self):
+        """
+        Returns:
+            stats_interval(float): seconds between queue statistics prints
+        """
+        return self.args.stats_interval
+
 
 class BatchedData(object):
     """
-    BatchedData is class that contain only static members, which are used
-    for cleaner interpretation of sent data by client. Contains cpu_usage,
-    uptime, temperature, clock_arm and bitrate. Also has print() method which
-    prints current state of the members.
+    BatchedData is class used for cleaner interpretation of sent data by client.
+    Contains cpu_usage, uptime, temperature, clock_arm and bitrate. Also has print()
+    method which prints current state of the members. Every parsed packet gets its
+    own instance, so that instances can be passed between pipeline stages. Timestamp
+    is time of the sample sent by client (arrival time for older clients).
     """
 
+    timestamp = 0.0
     cpu_usage = ""
     uptime = ""
     temperature = ""
     clock_arm = ""
     bitrate = ("", "")
+    network = {}
+    network_rate = (0.0, 0.0)
+    tcp_info = {}
+    snapshot = {}
 
-    @staticmethod
-    def print():
+    def print(self):
         """
         Prints current state of the members of BatchedData.
         """
-        print('{} - {} - {} - {} - {} - {}'.format(
-            BatchedData.cpu_usage, BatchedData.uptime, BatchedData.temperature, 
-            BatchedData.clock_arm, BatchedData.bitrate[0], BatchedData.bitrate[1]
+        print('{} - {} - {} - {} - {} - {} - {:.3f} - {:.3f}'.format(
+            self.cpu_usage, self.uptime, self.temperature, 
+            self.clock_arm, self.bitrate[0], self.bitrate[1],
+            self.network_rate[0], self.network_rate[1]
         ))
     
 
+class ClientConnection(object):
+    """
+    ClientConnection wraps socket of one connected client. Every client gets
+    its own instance, so that many clients can be served at the same time.
+    """
+
+    def __init__(self, client_socket, client_addr_info, buffer_size):
+        """
+        Attributes:
+            client_socket(socket.socket): socket returned by accept()
+            client_addr_info(tuple(str, int)): client ip address and port
+            buffer_size(int): packet size that will be received
+        """
+        self.client_socket = client_socket
+        self.client_addr_info = client_addr_info
+        self.buffer_size = buffer_size
+        self.framed = False
+        self.pending = ""
+
+    def close(self):
+        """
+        Closes client socket.
+        """
+        self.client_socket.close()
+
+    def receive_and_decode_data(self):
+        """
+        Receives packets with the size of self.buffer_size, decodes it and
+        then return.
+
+        Returns:
+            decoded_data(str): data received and decoded from client.
+        """
+        received_data = self.client_socket.recv(self.buffer_size)
+        decoded_data = received_data.decode("utf8")
+        return decoded_data
+
+    def receive_messages(self):
+        """
+        Receives packets and splits them into messages. Clients, which have introduced
+        themselves with HELLO, end every message with a new line, so one packet can
+        contain many messages or only part of one. For older clients every packet is
+        one message.
+
+        Returns:
+            messages(list(str)): complete messages, None if client has closed connection
+        """
+        received_data = self.receive_and_decode_data()
+        if len(received_data) == 0:
+            return None
+        if not self.framed:
+            return [received_data]
+
+        self.pending += received_data
+        *messages, self.pending = self.pending.split("\n")
+        return messages
+
+    def encode_and_send_data(self, data):
+        """
+        Encodes given data and sends it to the connected client.
+
+        Attributes:
+            data(str): data in str format, that is ready to sent.
+        """
+        if self.framed:
+            data += "\n"
+        encoded_data = data.encode('utf8')
+        self.client_socket.sendall(encoded_data)
+
+    def retrieve_client_ip_addr(self):
+        """
+        Returns connected client ip address.
+
+        Returns:
+            ip_addr(str): clients ip address
+        """
+        return self.client_addr_info[0]
+
+
 class TCPServer(object):
     """
     TCPServer is a class for creating server and management all incoming connections.
     It is also helper for retrieving batched data from the received data.
     """
 
+    connections_backlog = 128
+    base_keys = ("Time", "CPU_Usage", "Uptime", "Temperature", "ClockArm", "SendBitrate", "RecvBitrate")
+
     def __init__(self, server_addr, buffer_size):
         """
         Initializes socket and binds server. If cannot be bound, method exits the program.
-        Looks for only one device!
 
         Attributes:
             server_addr(tuple(str, int)): str should contain ip address and int should be port
             buffer_size(int): packet size that will be received
         """
-        self.client_socket = None
-        self.client_addr_info = ("Unknown", -1)
         self.buffer_size = buffer_size
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # restarted server can bind again while old connections are in TIME_WAIT
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         try:
             self.server_socket.bind(server_addr)
@@ -170,232 +330,1170 @@ class TCPServer(object):
             print("OSError: address already in use, other app is using it...")
             exit(0)
 
-        self.server_socket.listen(1)
+        self.server_socket.listen(TCPServer.connections_backlog)
 
     def accept_incoming_connection_if_available(self):
         """
         Accepts incoming connection and prints data about the client connected.
+
+        Returns:
+            connection(ClientConnection): newly connected client
         """
-        self.client_socket, self.client_addr_info = self.server_socket.accept()
-        print(self.client_addr_info)
+        client_socket, client_addr_info = self.server_socket.accept()
+        print(client_addr_info)
+        return ClientConnection(client_socket, client_addr_info, self.buffer_size)
 
-    def receive_and_decode_data(self):
+    @staticmethod
+    def retrieve_values(data):
         """
-        Receives packets with the size of self.buffer_size, decodes it and
-        then return.
+        Splits message into its "Key: value" pairs.
+
+        Attributes:
+            data(str): received message
 
         Returns:
-            decoded_data(str): data received and decoded from client.
+            values(dict(str, str)): key with its value
         """
-        received_data = self.client_socket.recv(self.buffer_size)
-        decoded_data = received_data.decode("utf8")
-        return decoded_data
+        return dict(re.findall(r"(\S+): (\S+)", data))
 
-    def encode_and_send_data(self, data):
+    def retrieve_batched_data_from_values(self, values):
         """
-        Encodes given data and sends it to the connected client.
+        Method retrieves all needed information from split message, e.g. sample rebuilt
+        by SeriesReconstructor. Network statistics are sent as "Net<Name>[<interface>]"
+        and connection statistics as "Tcp<Name>". Any other key (e.g. "CpuCore[0]")
+        is stored in snapshot, so that client can send new values without changes here.
 
         Attributes:
-            data(str): data in str format, that is ready to sent.
+            values(dict(str, str)): key with its value, see retrieve_values()
+
+        Returns:
+            BatchedData(): instance of the BatchedData()
         """
-        encoded_data = data.encode('utf8')
-        self.client_socket.send(encoded_data)
+        retrieved = BatchedData()
+        retrieved.timestamp = float(values["Time"]) if "Time" in values else time.time()
+        retrieved.cpu_usage = float(values["CPU_Usage"])
+        retrieved.uptime = float(values["Uptime"])
+        retrieved.temperature = float(values["Temperature"])
+        retrieved.clock_arm = float(values["ClockArm"])
+        retrieved.bitrate = (float(values["SendBitrate"]), float(values["RecvBitrate"]))
+
+        retrieved.network = {}
+        retrieved.tcp_info = {}
+        retrieved.snapshot = {}
+        for key, value in values.items():
+            if key in TCPServer.base_keys:
+                continue
 
-    def retrieve_client_ip_addr(self):
+            network_key = re.match(r"Net(\w+)\[(.+)\]$", key)
+            if network_key:
+                name, interface = network_key.groups()
+                retrieved.network.setdefault(interface, {})[name] = float(value)
+            elif key.startswith("Tcp"):
+                retrieved.tcp_info[key[len("Tcp"):]] = float(value)
+            else:
+                retrieved.snapshot[key] = float(value)
+
+        retrieved.network_rate = (
+            sum(statistics.get("Rx", 0.0) for statistics in retrieved.network.values()),
+            sum(statistics.get("Tx", 0.0) for statistics in retrieved.network.values())
+        )
+
+        return retrieved
+
+
+class SeriesReconstructor(object):
+    """
+    SeriesReconstructor rebuilds every sample of one device from messages filtered
+    by client DeadbandFilter. Skipped values are predicted the same way as client does
+    (last value, extrapolated with its slope), so that rebuilt values are never further
+    than tolerance from the real ones. Messages without Seq are passed unchanged.
+    Client sends "Resync" with the first message after reconnect, because messages sent
+    before may have been lost. After it, restart of the client or at the beginning,
+    skipped samples cannot be predicted, so nothing is rebuilt until the next heartbeat.
+    """
+
+    def __init__(self):
+        """
+        Creates reconstructor, which has not received any message yet.
+        """
+        self.resync()
+
+    def resync(self):
+        """
+        Forgets received values, samples are rebuilt again from the next heartbeat.
+        """
+        self.seq = None
+        self.predictors = {}
+
+    def __predict_all(self, seq):
         """
-        Returns currently connected clients ip address.
+        Attributes:
+            seq(int): sequence number of the sample
 
         Returns:
-            ip_addr(str): clients ip address
+            values(dict(str, float)): predicted value of every known metric
         """
-        return self.client_addr_info[0]
+        return {key: value + slope * (seq - sent_seq) for key, (value, slope, sent_seq) in self.predictors.items()}
 
-    def retrieve_batched_data(self, batched_data):
+    def reconstruct(self, values):
         """
-        Method retrieves all needed information from batched data. It is expected
-        that second package sent will contain those information.
+        Updates predictors with received values and rebuilds all samples since the
+        previous message.
 
         Attributes:
-            batched_data(str): batched data sent, that contains all Linux machine parameters
+            values(dict(str, str)): received message, see TCPServer.retrieve_values()
 
         Returns:
-            BatchedData(): instance of the BatchedData()
+            samples(list(dict)): rebuilt samples ordered by their sequence numbers, empty
+                while waiting for heartbeat
+        """
+        values = dict(values)
+        if values.pop("Resync", None):
+            self.resync()
+        if "Seq" not in values:
+            return [values] if values else []
+
+        seq = int(values.pop("Seq"))
+        heartbeat = values.pop("Heartbeat", None)
+
+        # after resync or restart of the client, samples before the heartbeat are unknown
+        if self.seq is None or seq <= self.seq:
+            if not heartbeat:
+                self.resync()
+                return []
+            samples = []
+        else:
+            samples = [self.__predict_all(skipped_seq) for skipped_seq in range(self.seq + 1, seq)]
+
+        if heartbeat:
+            self.predictors = {}
+        for key, value in values.items():
+            if not key.startswith("Slope["):
+                slope = float(values.get("Slope[{}]".format(key), 0.0))
+                self.predictors[key] = (float(value), slope, seq)
+
+        samples.append(self.__predict_all(seq))
+        self.seq = seq
+        return samples
+
+
+class DeviceSession(object):
+    """
+    DeviceSession keeps everything server knows about one device, so that it does not
+    have to be recomputed when the device reconnects with its session token.
+    """
+
+    def __init__(self, device_id, session_token, ip_addr, capabilities):
+        """
+        Attributes:
+            device_id(str): persistent device identifier sent by the client
+            session_token(str): token, which client sends back after reconnect
+            ip_addr(str): current ip address of the device
+            capabilities(dict(str, str)): metric name with the name of its backend
         """
-        double_values_in = r"[-+]?\d*\.\d+|\d+"
-        output_lst = re.findall(double_values_in, batched_data)
+        self.device_id = device_id
+        self.session_token = session_token
+        self.ip_addr = ip_addr
+        self.capabilities = capabilities
+        self.mac_info = None
+        self.relay = False
+        self.relay_stream = None
+        self.relay_batch = 0
+        self.relay_lock = threading.Lock()
+        self.connections = 0
+        self.last_seen = time.monotonic()
+
+
+class SessionRegistry(object):
+    """
+    SessionRegistry creates sessions for new devices and resumes sessions of the
+    reconnecting ones, which send back the session token of their device. Device
+    id alone is not enough, client without the right token (e.g. restarted or other
+    peer with the same id) gets fresh session of the device. Sessions of devices
+    disconnected longer than session_ttl are removed. It is shared by all receiving
+    threads.
+    """
+
+    protocol_version = 1
+    supported_protocol_versions = ("1",)
+    session_ttl = 24 * 60 * 60
 
-        BatchedData.cpu_usage = float(output_lst[0])
-        BatchedData.uptime = float(output_lst[1])
-        BatchedData.temperature = float(output_lst[2])
-        BatchedData.clock_arm = float(output_lst[3])
-        BatchedData.bitrate = (float(output_lst[4]), float(output_lst[5]))
+    def __init__(self):
+        """
+        Creates empty registry.
+        """
+        self.lock = threading.Lock()
+        self.sessions = {}
 
-        return BatchedData()
+    def __remove_expired(self, now):
+        """
+        Removes sessions without connection, which have not been seen for session_ttl.
 
+        Attributes:
+            now(float): current time.monotonic()
+        """
+        expired = [
+            device_id for device_id, session in self.sessions.items()
+            if session.connections == 0 and now - session.last_seen > SessionRegistry.session_ttl
+        ]
+        for device_id in expired:
+            del self.sessions[device_id]
+
+    def resume_or_create(self, hello, ip_addr):
+        """
+        Resumes session of the device, if token sent in HELLO matches, otherwise creates
+        new session of the device. Session is marked as connected until release() is called.
 
-class Subplotter(object):
+        Attributes:
+            hello(dict(str, str)): values of the HELLO message
+            ip_addr(str): ip address of the connected client
+
+        Returns:
+            session(DeviceSession): session of the device
+            resumed(bool): True if existing session has been found
+        """
+        device_id = hello.get("DeviceId", ip_addr)
+        capabilities = dict(
+            capability.split("=", 1) for capability in hello.get("Capabilities", "").split(",") if "=" in capability
+        )
+        now = time.monotonic()
+
+        with self.lock:
+            self.__remove_expired(now)
+
+            session = self.sessions.get(device_id)
+            token = hello.get("Session", "").encode("utf8")
+            resumed = session is not None and secrets.compare_digest(session.session_token.encode("utf8"), token)
+            if not resumed:
+                session = DeviceSession(device_id, secrets.token_hex(8), ip_addr, capabilities)
+                self.sessions[device_id] = session
+            elif session.ip_addr != ip_addr:
+                session.ip_addr = ip_addr
+                session.mac_info = None
+
+            session.capabilities = capabilities
+            session.connections += 1
+            session.last_seen = now
+            return session, resumed
+
+    def release(self, session):
+        """
+        Marks that one connection of the session has ended.
+
+        Attributes:
+            session(DeviceSession): session returned by resume_or_create()
+        """
+        with self.lock:
+            session.connections -= 1
+            session.last_seen = time.monotonic()
+
+
+class BoundedQueue(object):
     """
-    Subplotter is a helper class for Plotter. It contains all needed
-    information for one subplot, it definitely makes Plotter much cleaner,
-    when data is separated from implementation.
+    BoundedQueue connects two pipeline stages. When it is full, put() either blocks
+    the producer (BLOCK) or discards the oldest item (DROP_OLDEST), so that memory
+    usage is always limited. It also counts statistics used to observe stages.
+    Callback on_drop is called with every dropped item while condition is held, so
+    that code holding condition sees dropped and queued items consistently.
     """
 
-    def __init__(self, axs, x,color):
+    BLOCK = "block"
+    DROP_OLDEST = "drop_oldest"
+
+    def __init__(self, name, capacity, policy, on_drop=None):
+        """
+        Attributes:
+            name(str): name printed with statistics
+            capacity(int): maximum number of queued items
+            policy(str): BoundedQueue.BLOCK or BoundedQueue.DROP_OLDEST
+            on_drop(callable): called with every item dropped by DROP_OLDEST, None ignores them
         """
-        Initializes object with created subplot, its x axis data.
+        self.name = name
+        self.capacity = capacity
+        self.policy = policy
+        self.on_drop = on_drop
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.max_depth = 0
+        self.dropped = 0
+        self.total = 0
+
+    def put(self, item):
+        """
+        Attributes:
+            item(object): item passed to the next stage
+        """
+        with self.condition:
+            if len(self.items) >= self.capacity:
+                if self.policy == BoundedQueue.DROP_OLDEST:
+                    dropped_item = self.items.popleft()
+                    self.dropped += 1
+                    if self.on_drop:
+                        self.on_drop(dropped_item)
+                else:
+                    while len(self.items) >= self.capacity:
+                        self.condition.wait()
+
+            self.items.append(item)
+            self.total += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.condition.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Attributes:
+            timeout(float): maximum waiting time in seconds, None waits forever
 
+        Returns:
+            item(object): the oldest item or None, if timeout has passed
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.items, timeout):
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    def get_all(self):
+        """
+        Returns:
+            items(list): all currently queued items, does not wait
+        """
+        with self.condition:
+            items = list(self.items)
+            self.items.clear()
+            self.condition.notify_all()
+            return items
+
+    def get_stats(self):
+        """
+        Returns:
+            stats(dict): current depth, capacity, max depth, dropped and total items
+        """
+        with self.condition:
+            return {
+                "depth": len(self.items), "capacity": self.capacity,
+                "max_depth": self.max_depth, "dropped": self.dropped, "total": self.total
+            }
+
+
+class UpstreamForwarder(object):
+    """
+    UpstreamForwarder makes this server a relay. Messages of all local clients are sent
+    to the upstream server over one persistent connection, every line is prefixed with
+    "Device: <device id>", so that upstream can split them back per device. Messages
+    are sent in batches ended with "Batch: <number> Stream: <stream id>" line. Batch is
+    kept until upstream acknowledges it with "Ack: <number>" and is sent again after
+    reconnect, upstream ignores batches it has already received. During upstream outage
+    messages wait in the forward queue, when it is full the oldest are dropped and
+    "Resync" marker is sent before the next messages of their devices, so that upstream
+    does not rebuild samples over the gap.
+    """
+
+    keepalive_idle = 10
+    keepalive_interval = 5
+    keepalive_count = 3
+
+    def __init__(self, upstream_addr, listen_addr, buffer_size, capacity=65536, flush_interval=1.0,
+                 reconnect_delay=5.0, ack_timeout=30.0):
+        """
         Attributes:
-            axs(): subplot from matplotlib
-            x(list(int)): list for x axis
+            upstream_addr(tuple(str, int)): upstream server ip address and port
+            listen_addr(tuple(str, int)): address of this relay, identifies it upstream, so that
+                more relays on one machine get their own sessions
+            buffer_size(int): packet size for receiving upstream replies
+            capacity(int): number of messages buffered in the forward queue during upstream outage
+            flush_interval(float): maximum time, which message waits for its batch
+            reconnect_delay(float): seconds between reconnect attempts
+            ack_timeout(float): seconds to wait for upstream reply, then connection is considered lost
+        """
+        self.upstream_addr = upstream_addr
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.reconnect_delay = reconnect_delay
+        self.ack_timeout = ack_timeout
+        self.forward_queue = BoundedQueue("forward", capacity, BoundedQueue.DROP_OLDEST, on_drop=self.__mark_dropped)
+        self.dropped_devices = set()
+        self.relay_id = "relay-{}-{}-{}".format(socket.gethostname(), listen_addr[0], listen_addr[1])
+        self.stream_id = secrets.token_hex(8)
+        self.session_token = None
+        self.pending = ""
+        self.batch = []
+        self.batch_seq = 0
+        self.forwarded = 0
+
+    def start(self):
+        """
+        Starts forwarding thread. Thread is a daemon, so it ends together with the main thread.
+        """
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def __mark_dropped(self, item):
+        """
+        Remembers device of the message dropped by the forward queue.
+
+        Attributes:
+            item(tuple(str, str)): dropped device id and message
+        """
+        self.dropped_devices.add(item[0])
+
+    def __connect(self):
+        """
+        Connects to upstream and introduces relay with HELLO message. Socket has timeout
+        and TCP keepalive, so that dead upstream is detected also without sending.
+
+        Returns:
+            upstream_socket(socket.socket): connected socket
+        """
+        upstream_socket = socket.create_connection(self.upstream_addr, timeout=self.ack_timeout)
+        upstream_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (("TCP_KEEPIDLE", UpstreamForwarder.keepalive_idle),
+                              ("TCP_KEEPINTVL", UpstreamForwarder.keepalive_interval),
+                              ("TCP_KEEPCNT", UpstreamForwarder.keepalive_count)):
+            if hasattr(socket, option):
+                upstream_socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+        hello = "HELLO: {} DeviceId: {} Session: {} Relay: 1\n".format(
+            SessionRegistry.protocol_version, self.relay_id, self.session_token or "-")
+        self.pending = ""
+        try:
+            upstream_socket.sendall(hello.encode("utf8"))
+            welcome = self.__receive_reply(upstream_socket)
+        except OSError:
+            upstream_socket.close()
+            raise
+        if not welcome.startswith("WELCOME:"):
+            upstream_socket.close()
+            raise ConnectionResetError("Unexpected handshake reply: {}".format(welcome))
+        self.session_token = TCPServer.retrieve_values(welcome).get("Session")
+        return upstream_socket
+
+    def __receive_reply(self, upstream_socket):
+        """
+        Attributes:
+            upstream_socket(socket.socket): connected socket
+
+        Returns:
+            reply(str): next line sent by upstream
+        """
+        while "\n" not in self.pending:
+            received_data = upstream_socket.recv(self.buffer_size)
+            if len(received_data) == 0:
+                raise ConnectionResetError("Upstream has closed connection")
+            self.pending += received_data.decode("utf8")
+        reply, self.pending = self.pending.split("\n", 1)
+        return reply
+
+    def __take_batch(self):
+        """
+        Waits for messages and takes all of them as the next batch.
+
+        Returns:
+            batch(list(tuple(str, str))): device id with its message, None if nothing has come
         """
-        self.color = color
-        self.axs = axs
-        self.y = np.array([0])
-        self.lines, = self.axs.plot(x, self.y,color=color)
+        first = self.forward_queue.get(timeout=self.flush_interval)
+        if first is None:
+            return None
+        time.sleep(self.flush_interval)
+
+        # devices are taken together with messages, so that every gap is marked before
+        # the messages queued after it
+        with self.forward_queue.condition:
+            dropped_devices, self.dropped_devices = self.dropped_devices, set()
+            queued = self.forward_queue.get_all()
 
+        markers = [(device_id, "Resync: 1") for device_id in sorted(dropped_devices)]
+        return markers + [first] + queued
 
-    def append_new_value(self, val):
+    def __run(self):
         """
-        Appends new value to y axis.
+        Forwards batches until the program ends, reconnects after upstream failure.
+        Batch, which has not been acknowledged, is sent again after reconnect.
+        """
+        upstream_socket = None
+
+        while True:
+            if upstream_socket is None:
+                try:
+                    upstream_socket = self.__connect()
+                    print("Connected to upstream {}:{} as {}".format(
+                        self.upstream_addr[0], self.upstream_addr[1], self.relay_id))
+                except OSError as error:
+                    print("Upstream unavailable ({}), {} messages buffered, retrying in {}s...".format(
+                        error, len(self.batch) + self.forward_queue.get_stats()["depth"], self.reconnect_delay))
+                    time.sleep(self.reconnect_delay)
+                    continue
+
+            if not self.batch:
+                batch = self.__take_batch()
+                if batch is None:
+                    continue
+                self.batch = batch
+                self.batch_seq += 1
+
+            payload = "".join("Device: {} {}\n".format(device_id, message) for device_id, message in self.batch)
+            payload += "Batch: {} Stream: {}\n".format(self.batch_seq, self.stream_id)
+            try:
+                upstream_socket.sendall(payload.encode("utf8"))
+                acknowledged = None
+                while acknowledged != self.batch_seq:
+                    acknowledged = int(TCPServer.retrieve_values(self.__receive_reply(upstream_socket))["Ack"])
+            except (OSError, KeyError, ValueError) as error:
+                print("Upstream connection lost ({}), reconnecting...".format(error))
+                upstream_socket.close()
+                upstream_socket = None
+                continue
+
+            self.forwarded += len(self.batch)
+            self.batch = []
+
+
+class ServerPipeline(object):
+    """
+    ServerPipeline runs receiving, parsing and persisting in separate threads connected
+    by bounded queues. Each client has its own receiving thread. Drawing is done by the
+    main thread (GUI requirement), which drains the UI queue with get_all(). UI queue
+    drops the oldest samples, so slow GUI never stalls ingest, while persisting queue
+    blocks, so that no sample is lost on its way to the output file. In relay mode
+    received messages are also passed to UpstreamForwarder through the forward queue.
+    """
 
+    def __init__(self, server, output_file=None, queue_capacity=4096, sample_interval=2.0,
+                 dashboard=True, upstream_addr=None, forward_capacity=65536, mac_lookup=True, verbose=False):
+        """
         Attributes:
-            val(int): value, which will be appended to y axis
+            server(TCPServer): bound server, which accepts clients
+            output_file(str): path of the CSV file for received samples, None disables it
+            queue_capacity(int): capacity of every queue
+            sample_interval(float): seconds between samples, sent to clients in handshake
+            dashboard(bool): False if nobody drains the UI queue (headless server)
+            upstream_addr(tuple(str, int)): upstream server for relay mode, None disables it
+            forward_capacity(int): number of messages buffered during upstream outage
+            mac_lookup(bool): False disables ARP and vendor lookup of connected clients
+            verbose(bool): True prints every persisted sample
+        """
+        self.server = server
+        # bad path fails at start, not in the persisting thread
+        self.output = open(output_file, "a") if output_file else None
+        self.write_failures = 0
+        self.sample_interval = sample_interval
+        self.mac_lookup = mac_lookup
+        self.verbose = verbose
+        self.registry = SessionRegistry()
+        self.reconstructors = {}
+        self.parse_queue = BoundedQueue("parse", queue_capacity, BoundedQueue.BLOCK)
+        self.persist_queue = BoundedQueue("persist", queue_capacity, BoundedQueue.BLOCK)
+        self.ui_queue = BoundedQueue("ui", queue_capacity, BoundedQueue.DROP_OLDEST) if dashboard else None
+
+        self.forward_queue = None
+        self.forwarder = None
+        if upstream_addr:
+            self.forwarder = UpstreamForwarder(
+                upstream_addr, server.server_socket.getsockname(), server.buffer_size, forward_capacity)
+            self.forward_queue = self.forwarder.forward_queue
+
+    def start(self):
+        """
+        Starts accepting, parsing and persisting threads. Threads are daemons, so they
+        end together with the main thread.
         """
-        self.y = np.append(self.y, val)
+        for target in (self.__accept_stage, self.__parse_stage, self.__persist_stage):
+            threading.Thread(target=target, daemon=True).start()
+        if self.forwarder:
+            self.forwarder.start()
 
-    def draw(self, x):
+    def get_queue_stats(self):
+        """
+        Returns:
+            stats(dict(str, dict)): queue name with its statistics
+        """
+        queues = (self.parse_queue, self.persist_queue, self.ui_queue, self.forward_queue)
+        return {queue.name: queue.get_stats() for queue in queues if queue is not None}
+
+    def print_queue_stats(self):
+        """
+        Prints statistics of all queues.
         """
-        Updates x and y axis, recalculates the whole plot and scale with the new data.
+        for name, stats in self.get_queue_stats().items():
+            print("QUEUE {}: depth {}/{} max {} dropped {} total {}".format(
+                name, stats["depth"], stats["capacity"], stats["max_depth"], stats["dropped"], stats["total"]))
+
+    def __accept_stage(self):
+        """
+        Accepts clients and starts receiving thread for each of them.
+        """
+        while True:
+            connection = self.server.accept_incoming_connection_if_available()
+            threading.Thread(target=self.__receive_stage, args=(connection,), daemon=True).start()
+
+    def __handshake(self, connection, first_message):
+        """
+        Answers HELLO message with server configuration in one round trip. Clients
+        without HELLO (older versions) get their first message echoed back and are
+        identified by their ip address. Unsupported protocol version is answered with
+        ERROR and connection is refused.
 
         Attributes:
-            x(list(int)): list of the x axis data
+            connection(ClientConnection): connected client
+            first_message(str): first message received from the client
+
+        Returns:
+            session(DeviceSession): session of the device, None for older clients
         """
-        self.lines.set_xdata(x)
-        self.lines.set_ydata(self.y)
-        self.axs.relim()
-        self.axs.autoscale_view()
+        clients_ip_addr = connection.retrieve_client_ip_addr()
+        if not first_message.startswith("HELLO:"):
+            print(first_message)
+            connection.encode_and_send_data(first_message)
+            return None
+
+        hello = TCPServer.retrieve_values(first_message)
+        if hello.get("HELLO") not in SessionRegistry.supported_protocol_versions:
+            connection.encode_and_send_data("ERROR: unsupported protocol version {}, supported: {}".format(
+                hello.get("HELLO"), ",".join(SessionRegistry.supported_protocol_versions)))
+            raise ConnectionRefusedError("unsupported protocol version {}".format(hello.get("HELLO")))
+
+        session, resumed = self.registry.resume_or_create(hello, clients_ip_addr)
+
+        session.relay = hello.get("Relay") == "1"
+
+        connection.encode_and_send_data("WELCOME: {} Session: {} Interval: {}".format(
+            SessionRegistry.protocol_version, session.session_token, self.sample_interval))
+        print("{} {} {} from {}, capabilities: {}".format(
+            "Resumed" if resumed else "New", "relay" if session.relay else "device",
+            session.device_id, clients_ip_addr, session.capabilities))
+        return session
+
+    def __pass_message(self, device_id, message):
+        """
+        Passes received message to the parsing stage and, in relay mode, to upstream.
 
+        Attributes:
+            device_id(str): identifier of the device, which has sent message
+            message(str): received message
+        """
+        self.parse_queue.put((device_id, message))
+        if self.forward_queue is not None:
+            self.forward_queue.put((device_id, message))
+
+    def __pass_relayed_batch(self, connection, session, batch, terminator):
+        """
+        Passes messages of one batch received from relay, every message is prefixed with
+        its device. Batch is acknowledged after its messages are queued, batch sent again
+        after reconnect of the relay is only acknowledged.
 
-class Plotter(object):
+        Attributes:
+            connection(ClientConnection): connected relay
+            session(DeviceSession): session of the relay
+            batch(list(str)): received "Device: <device id> <message>" lines
+            terminator(str): "Batch: <number> Stream: <stream id>" line ending the batch
+        """
+        values = TCPServer.retrieve_values(terminator)
+        try:
+            stream_id, batch_seq = values["Stream"], int(values["Batch"])
+        except (KeyError, ValueError):
+            print("Cannot parse batch from {}: {}".format(session.device_id, terminator))
+            return
+
+        # old connection of the relay may still be open, batches are passed one at a time
+        with session.relay_lock:
+            if stream_id != session.relay_stream or batch_seq > session.relay_batch:
+                for message in batch:
+                    relayed = message.split(" ", 2)
+                    if len(relayed) != 3 or relayed[0] != "Device:":
+                        print("Cannot split relayed message from {}: {}".format(session.device_id, message))
+                        continue
+                    _, device_id, message = relayed
+                    self.__pass_message(device_id, message)
+                session.relay_stream = stream_id
+                session.relay_batch = batch_seq
+
+        connection.encode_and_send_data("Ack: {}".format(batch_seq))
+
+    def __receive_stage(self, connection):
+        """
+        Receives packets of one client and passes them to the parsing stage.
+
+        Attributes:
+            connection(ClientConnection): connected client
+        """
+        clients_ip_addr = connection.retrieve_client_ip_addr()
+        session = None
+        try:
+            first_packet = connection.receive_and_decode_data()
+            if len(first_packet) == 0:
+                return
+
+            # client waits for WELCOME, so HELLO is the only message in the first packet
+            first_message = first_packet.rstrip("\n")
+            if first_message.startswith("HELLO:"):
+                connection.framed = True
+
+            session = self.__handshake(connection, first_message)
+            device_id = session.device_id if session else clients_ip_addr
+
+            relay = session is not None and session.relay
+
+            if not self.mac_lookup:
+                mac_info = None
+            elif session is None or session.mac_info is None:
+                mac_info = MACManager.get_mac_info_of_ip(clients_ip_addr)
+                if session is not None:
+                    session.mac_info = mac_info
+            else:
+                mac_info = session.mac_info
+            if mac_info:
+                print("MAC_INFO: {} - {} - {}".format(mac_info[0]['ip'], mac_info[0]['mac'], mac_info[0]['vendor']))
+
+            batch = []
+            messages = connection.receive_messages()
+            while messages is not None:
+                for message in messages:
+                    if not relay:
+                        self.__pass_message(device_id, message)
+                    elif message.startswith("Batch:"):
+                        self.__pass_relayed_batch(connection, session, batch, message)
+                        batch = []
+                    else:
+                        batch.append(message)
+                messages = connection.receive_messages()
+            print("Clossing connection with {}...".format(device_id))
+        except ConnectionRefusedError as error:
+            print("Connection with {} refused: {}".format(clients_ip_addr, error))
+        except (ConnectionResetError, BrokenPipeError):
+            print("Connection with {} has been reset...".format(clients_ip_addr))
+        finally:
+            connection.close()
+            if session is not None:
+                self.registry.release(session)
+
+    def __parse_stage(self):
+        """
+        Parses received packets, rebuilds samples skipped by client deadband filter
+        and passes them to persisting and UI stages.
+        """
+        while True:
+            device_id, received_data = self.parse_queue.get()
+            reconstructor = self.reconstructors.setdefault(device_id, SeriesReconstructor())
+
+            try:
+                samples = reconstructor.reconstruct(TCPServer.retrieve_values(received_data))
+                samples = [self.server.retrieve_batched_data_from_values(values) for values in samples]
+            except (KeyError, ValueError):
+                print("Cannot parse data from {}: {}".format(device_id, received_data))
+                continue
+
+            for batched_data in samples:
+                self.persist_queue.put((device_id, batched_data))
+                if self.ui_queue is not None:
+                    self.ui_queue.put((device_id, batched_data))
+
+    def __persist_stage(self):
+        """
+        Appends parsed samples to the output file, if it is given. All samples waiting
+        in the queue are written and flushed at once. Samples are printed only in verbose
+        mode, because terminal would limit the whole pipeline. Samples, which cannot be
+        written (e.g. full disk), are dropped and counted, so that the queue is still
+        drained and receiving never stalls.
+        """
+        while True:
+            samples = [self.persist_queue.get()] + self.persist_queue.get_all()
+
+            if self.verbose:
+                for _, batched_data in samples:
+                    batched_data.print()
+
+            if self.output:
+                rows = []
+                for device_id, batched_data in samples:
+                    snapshot = " ".join("{}={}".format(key, value) for key, value in batched_data.snapshot.items())
+                    rows.append("{},{},{},{},{},{},{},{},{},{},{}\n".format(
+                        batched_data.timestamp, device_id, batched_data.cpu_usage, batched_data.uptime,
+                        batched_data.temperature, batched_data.clock_arm,
+                        batched_data.bitrate[0], batched_data.bitrate[1],
+                        batched_data.network_rate[0], batched_data.network_rate[1], snapshot
+                    ))
+                try:
+                    self.output.write("".join(rows))
+                    self.output.flush()
+                except OSError as error:
+                    if self.write_failures == 0:
+                        print("Cannot write to output file ({}), samples are dropped...".format(error))
+                    self.write_failures += len(rows)
+                    continue
+
+                if self.write_failures:
+                    print("Writing to output file recovered, {} samples dropped".format(self.write_failures))
+                    self.write_failures = 0
+
+
+class FleetState(object):
     """
-    Plotter is a matplotlib abstraction layer, which makes clear
-    what is plotted and what should be updated.
+    FleetState keeps aggregated state of all connected devices in preallocated
+    numpy arrays. Every device gets its own row, so that the newest values of the
+    whole fleet can be read with one slice instead of looping over devices.
     """
 
-    def __init__(self):
+    metrics = (
+        ("CPU usage", "cpu % use"),
+        ("Temperature", "*C"),
+        ("Clock ARM", "Hz"),
+        ("Upload", "Mbps"),
+        ("Download", "Mbps"),
+        ("Network RX", "Mbps"),
+        ("Network TX", "Mbps"),
+    )
+
+    def __init__(self, capacity=64, history_size=300):
         """
-        Creates 6 subplots for all client data.
+        Initializes empty state. Arrays grow automatically, when more devices than
+        capacity are connected.
+
+        Attributes:
+            capacity(int): initial number of device slots
+            history_size(int): number of samples kept per device for the drill-down
         """
-        self.iterator = 0
-        self.x_time = np.array([0])
+        self.history_size = history_size
+        self.devices = []
+        self.device_rows = {}
+        self.version = 0
+        self.__allocate(capacity)
 
-        self.figure, all_subplots = plt.subplots(6)
-        self.figure.tight_layout()
+    def __allocate(self, capacity):
+        """
+        Allocates (or grows) arrays, copies already collected data into them.
 
-        self.cpu_usage = Subplotter(all_subplots[0], self.x_time,'r')
-        self.cpu_usage.axs.set_ylabel("cpu % use")
-        self.cpu_usage.axs.set_title("CPU usage")
+        Attributes:
+            capacity(int): new number of device slots
+        """
+        metrics_count = len(FleetState.metrics)
+        current = np.full((metrics_count, capacity), np.nan)
+        history = np.full((capacity, metrics_count, self.history_size), np.nan)
+        samples = np.zeros(capacity, dtype=np.int64)
+
+        used = len(self.devices)
+        if used:
+            current[:, :used] = self.current[:, :used]
+            history[:used] = self.history[:used]
+            samples[:used] = self.samples[:used]
+
+        self.capacity = capacity
+        self.current = current
+        self.history = history
+        self.samples = samples
+
+    def row_of(self, device_id):
+        """
+        Returns row of given device, registers device if it is seen for the first time.
 
+        Attributes:
+            device_id(str): unique device identifier
 
-        self.uptime = Subplotter(all_subplots[1], self.x_time,'b')
-        self.uptime.axs.set_title("Uptime")
-        self.uptime.axs.set_ylabel("secounds")
+        Returns:
+            row(int): index of the device in state arrays
+        """
+        row = self.device_rows.get(device_id)
+        if row is None:
+            row = len(self.devices)
+            if row == self.capacity:
+                self.__allocate(self.capacity * 2)
+            self.devices.append(device_id)
+            self.device_rows[device_id] = row
+        return row
+
+    def update(self, device_id, batched_data):
+        """
+        Stores newest values of the device and appends them to its history.
 
-        self.temperature = Subplotter(all_subplots[2], self.x_time,'g')
-        self.temperature.axs.set_title("Temperature")
-        self.temperature.axs.set_ylabel("*C")
+        Attributes:
+            device_id(str): unique device identifier
+            batched_data(BatchedData): instance with all retrieved data from the client
+        """
+        row = self.row_of(device_id)
+        values = (
+            batched_data.cpu_usage, batched_data.temperature, batched_data.clock_arm,
+            batched_data.bitrate[0], batched_data.bitrate[1],
+            batched_data.network_rate[0], batched_data.network_rate[1]
+        )
+
+        self.current[:, row] = values
+        self.history[row, :, self.samples[row] % self.history_size] = values
+        self.samples[row] += 1
+        self.version += 1
+
+    def series_of(self, row):
+        """
+        Returns history of the device ordered from the oldest to the newest sample.
 
-        self.clock_arm = Subplotter(all_subplots[3], self.x_time,'r')
-        self.clock_arm.axs.set_title("Clock ARM")
-        self.clock_arm.axs.set_ylabel("Hz")
+        Attributes:
+            row(int): index of the device in state arrays
 
-        self.bitrate_send = Subplotter(all_subplots[4], self.x_time,'b')
-        self.bitrate_send.axs.set_title("Upload")
-        self.bitrate_send.axs.set_ylabel("Mbps")
+        Returns:
+            series(np.ndarray): array with shape (metrics, samples)
+        """
+        count = int(self.samples[row])
+        if count <= self.history_size:
+            return self.history[row, :, :count]
+        return np.roll(self.history[row], -(count % self.history_size), axis=1)
 
-        self.bitrate_recv = Subplotter(all_subplots[5], self.x_time,'g')
-        self.bitrate_recv.axs.set_title("Download")
-        self.bitrate_recv.axs.set_xlabel("Samples")
-        self.bitrate_recv.axs.set_ylabel("Mbps")
 
-        plt.show(block=False)
+class FleetPlotter(object):
+    """
+    FleetPlotter is a dashboard for the whole fleet. Upper row contains heatmaps with
+    current values of every device (one cell per device), lower row contains series
+    of the device selected by clicking on its cell. Figure is rendered at fixed
+    frame rate, each frame updates every heatmap with one set_data() call and blits
+    only changed artists on top of cached background. Everything, what changes with
+    data (images, lines, drill-down y axes and title), is animated, so that cached
+    background stays valid until the window is resized. Rendered y axis of every
+    drill-down is cached too and drawn again only when its limits change, at most
+    max_rescales axes per frame, the others are rescaled in the next frames.
+    """
 
-    def push_batched_data(self, batched_data):
+    max_rescales = 2
+
+    def __init__(self, fleet_state, fps=10.0, show=True):
         """
-        Pushes all collected data to the correct subplots.
+        Creates heatmaps and drill-down subplots for all metrics.
 
         Attributes:
-            batched_data(BatchedData): instance with all retrieved data from the client.
+            fleet_state(FleetState): aggregated state, which will be rendered
+            fps(float): maximum frame rate
+            show(bool): False for headless rendering (e.g. Agg backend)
         """
-        self.cpu_usage.append_new_value(batched_data.cpu_usage)
-        self.uptime.append_new_value(batched_data.uptime)
-        self.temperature.append_new_value(batched_data.temperature)
-        self.clock_arm.append_new_value(batched_data.clock_arm)
-        self.bitrate_send.append_new_value(batched_data.bitrate[0])
-        self.bitrate_recv.append_new_value(batched_data.bitrate[1])
+        self.state = fleet_state
+        self.frame_interval = 1.0 / fps
+        self.last_frame = 0.0
+        self.drawn_version = -1
+        self.selected_row = 0
+        self.grid_side = 0
+        self.background = None
+        self.axis_backgrounds = [None] * len(FleetState.metrics)
+
+        metrics_count = len(FleetState.metrics)
+        self.figure, all_subplots = plt.subplots(2, metrics_count, figsize=(3 * metrics_count, 6))
+        self.heatmaps = []
+        self.drill_downs = []
+
+        for i, (title, unit) in enumerate(FleetState.metrics):
+            heatmap_axs, drill_down_axs = all_subplots[0][i], all_subplots[1][i]
+
+            heatmap_axs.set_title(title)
+            heatmap_axs.set_xticks([])
+            heatmap_axs.set_yticks([])
+            image = heatmap_axs.imshow(np.full((1, 1), np.nan), cmap='viridis',
+                                       interpolation='nearest', animated=True)
+            self.heatmaps.append(image)
+
+            drill_down_axs.set_xlim(-fleet_state.history_size, 0)
+            drill_down_axs.set_ylabel(unit)
+            drill_down_axs.set_xlabel("Samples ago")
+            # fixed label position and fewer ticks make redrawing of the axis cheaper
+            drill_down_axs.yaxis.set_label_coords(-0.25, 0.5)
+            drill_down_axs.yaxis.set_major_locator(MaxNLocator(4))
+            drill_down_axs.yaxis.set_animated(True)
+            drill_down_axs.title.set_animated(True)
+            lines, = drill_down_axs.plot([], [], animated=True)
+            self.drill_downs.append((drill_down_axs, lines))
 
-    def draw(self):
+        self.figure.tight_layout()
+        self.figure.canvas.mpl_connect('button_press_event', self.__on_click)
+        self.figure.canvas.mpl_connect('resize_event', self.__on_resize)
+
+        if show:
+            plt.show(block=False)
+
+    def __on_click(self, event):
         """
-        Method draws new data to the figure created with constructor call.
-        Looks for ValueError.
+        Selects device for drill-down, when its heatmap cell has been clicked.
         """
-        try:
-            self.x_time = np.append(self.x_time, self.iterator)
-            self.iterator += 1
+        if event.inaxes is None or event.xdata is None or self.grid_side == 0:
+            return
+        if event.inaxes not in [image.axes for image in self.heatmaps]:
+            return
 
-            self.cpu_usage.draw(self.x_time)
-            self.uptime.draw(self.x_time)
-            self.temperature.draw(self.x_time)
-            self.clock_arm.draw(self.x_time)
-            self.bitrate_send.draw(self.x_time)
-            self.bitrate_recv.draw(self.x_time)
+        row = int(round(event.ydata)) * self.grid_side + int(round(event.xdata))
+        if row < len(self.state.devices):
+            self.select_device(self.state.devices[row])
 
-            self.figure.canvas.draw()
-            self.figure.canvas.flush_events()
-        except ValueError:
-            print("ValueError: shape mismatch: objects cannot be broadcast to a single shape")
+    def __on_resize(self, event):
+        """
+        Cached background is not valid anymore after window resize.
+        """
+        self.background = None
+
+    def select_device(self, device_id):
+        """
+        Chooses device, which series are shown in the drill-down subplots.
+
+        Attributes:
+            device_id(str): unique device identifier
+        """
+        self.selected_row = self.state.row_of(device_id)
+        self.drawn_version = -1
+
+    def __update_heatmaps(self):
+        """
+        Reshapes current values of the fleet into square grids and updates images.
+        """
+        devices_count = len(self.state.devices)
+        side = max(1, math.ceil(math.sqrt(devices_count)))
+        padded = np.full((len(FleetState.metrics), side * side), np.nan)
+        padded[:, :devices_count] = self.state.current[:, :devices_count]
+        grids = padded.reshape(-1, side, side)
+
+        # all metrics at once, NaN cells (free slots) are ignored
+        with np.errstate(all='ignore'):
+            minimums = np.nanmin(padded, axis=1) if devices_count else np.zeros(len(grids))
+            maximums = np.nanmax(padded, axis=1) if devices_count else np.ones(len(grids))
+
+        # heatmaps have no ticks, so new extent does not change background
+        for image, grid, vmin, vmax in zip(self.heatmaps, grids, minimums, maximums):
+            image.set_data(grid)
+            if side != self.grid_side:
+                image.set_extent((-0.5, side - 0.5, side - 0.5, -0.5))
+            if np.isfinite(vmin) and np.isfinite(vmax):
+                image.set_clim(vmin, vmax if vmax > vmin else vmin + 1)
+
+        self.grid_side = side
+
+    def __update_drill_down(self):
+        """
+        Updates subplots with series of the selected device. Y axis is rescaled only
+        when the series leaves current limits, so that its ticks are not recomputed
+        every frame.
+
+        Returns:
+            pending(bool): True if some axes have to be rescaled in the next frame
+        """
+        if self.selected_row >= len(self.state.devices):
+            return False
+
+        rescales = 0
+        pending = False
+        series = self.state.series_of(self.selected_row)
+        x = np.arange(1 - series.shape[1], 1)
+
+        for i, ((axs, lines), y) in enumerate(zip(self.drill_downs, series)):
+            lines.set_data(x, y)
+
+            with np.errstate(all='ignore'):
+                low, high = np.nanmin(y), np.nanmax(y)
+            if not (np.isfinite(low) and np.isfinite(high)):
+                continue
+
+            bottom, top = axs.get_ylim()
+            if bottom <= low and high <= top:
+                continue
+            if rescales == FleetPlotter.max_rescales:
+                pending = True
+                continue
+
+            margin = max((high - low) * 0.25, abs(high) * 0.1, 1e-3)
+            axs.set_ylim(low - margin, high + margin)
+            self.axis_backgrounds[i] = None
+            rescales += 1
+
+        self.drill_downs[0][0].set_title(self.state.devices[self.selected_row])
+        return pending
+
+    def draw(self):
+        """
+        Renders one frame of the fleet state, if anything has changed since last one.
+        Whole figure is drawn only for the first frame and after resize, otherwise only
+        animated artists are drawn on top of cached background.
+        """
+        if self.drawn_version == self.state.version:
+            return
+
+        self.__update_heatmaps()
+        pending = self.__update_drill_down()
+        # frame with remaining rescales is drawn even without new samples
+        self.drawn_version = -1 if pending else self.state.version
+
+        canvas = self.figure.canvas
+        if self.background is None:
+            canvas.draw()
+            self.background = canvas.copy_from_bbox(self.figure.bbox)
+            self.axis_backgrounds = [None] * len(self.drill_downs)
+        else:
+            canvas.restore_region(self.background)
+
+        # axis is drawn on clean background, so its cached region contains nothing else
+        for i, (axs, _) in enumerate(self.drill_downs):
+            if self.axis_backgrounds[i] is None:
+                self.figure.draw_artist(axs.yaxis)
+                region = axs.yaxis.get_tightbbox(canvas.get_renderer()).padded(2)
+                self.axis_backgrounds[i] = canvas.copy_from_bbox(region)
+            else:
+                canvas.restore_region(self.axis_backgrounds[i])
+
+        for image in self.heatmaps:
+            self.figure.draw_artist(image)
+        for _, lines in self.drill_downs:
+            self.figure.draw_artist(lines)
+        self.figure.draw_artist(self.drill_downs[0][0].title)
+
+        canvas.blit(self.figure.bbox)
+        canvas.flush_events()
+        self.last_frame = time.monotonic()
+
+    def draw_if_due(self):
+        """
+        Draws new frame only if frame interval has passed since the previous one, so
+        that number of received samples does not affect rendering cost.
+        """
+        if time.monotonic() - self.last_frame >= self.frame_interval:
+            self.draw()
 
 
 def main(args):
 
-    interfaces = MACManager.get_network_interfaces()
-    for interface in interfaces:
-        mac_info = MACManager.get_mac_info_of_interface(interface)
-        print("MAC_INFO: {} - {} - {}".format(mac_info['ip'], mac_info['mac'], mac_info['vendor']))
+    if args.is_mac_lookup_enabled():
+        interfaces = MACManager.get_network_interfaces()
+        for interface in interfaces:
+            mac_info = MACManager.get_mac_info_of_interface(interface)
+            print("MAC_INFO: {} - {} - {}".format(mac_info['ip'], mac_info['mac'], mac_info['vendor']))
 
     server = TCPServer(
         server_addr=args.get_server_data(),
         buffer_size=args.get_buffer()
     )
 
-    plotter = Plotter()
+    try:
+        pipeline = ServerPipeline(
+            server,
+            output_file=args.get_output_file(),
+            sample_interval=args.get_sample_interval(),
+            dashboard=not args.is_headless(),
+            upstream_addr=args.get_upstream_data(),
+            mac_lookup=args.is_mac_lookup_enabled(),
+            verbose=args.is_verbose()
+        )
+    except OSError as error:
+        exit("Cannot open output file: {}".format(error))
+    pipeline.start()
+
+    if args.is_headless():
+        while True:
+            time.sleep(args.get_stats_interval())
+            pipeline.print_queue_stats()
 
-    while True:
-        server.accept_incoming_connection_if_available()
-        clients_ip_addr = server.retrieve_client_ip_addr()
+    fleet_state = FleetState()
+    plotter = FleetPlotter(fleet_state, fps=args.get_fps())
+    last_stats = time.monotonic()
 
-        mac_info = MACManager.get_mac_info_of_ip(clients_ip_addr)
-        if mac_info:
-            print("MAC_INFO: {} - {} - {}".format(mac_info[0]['ip'], mac_info[0]['mac'], mac_info[0]['vendor']))
+    while True:
+        for device_id, batched_data in pipeline.ui_queue.get_all():
+            fleet_state.update(device_id, batched_data)
+        plotter.draw_if_due()
 
-        received_data = server.receive_and_decode_data()
-        print(received_data)
+        if time.monotonic() - last_stats >= args.get_stats_interval():
+            pipeline.print_queue_stats()
+            last_stats = time.monotonic()
 
-        server.encode_and_send_data(received_data)
+        # handles GUI events until the next frame, without redrawing the figure
+        plotter.figure.canvas.start_event_loop(plotter.frame_interval)
 
-        while True:
-            received_data = server.receive_and_decode_data()
-            print(received_data)
-            if len(received_data) == 0:
-                print("Clossing connection and waiting...")
-                break
-            
-            batched_data = server.retrieve_batched_data(received_data)
-            batched_data.print()
-
-            plotter.push_batched_data(batched_data)
-            plotter.draw()
-            
 
 if __name__ == "__main__":
     if os.geteuid() != 0: